@@ -36,9 +36,13 @@ class TransporterAgent:
     #   input_image = np.concatenate((input_image, goal_image), axis=2)
     #   assert input_image.shape[2] == 12, input_image.shape
 
-    # Get color and height maps from RGB-D images.
-    cmap, hmap = utils.get_fused_heightmap(
-        obs, self.cam_config, self.bounds, self.pix_size)
+    # Get color and height maps from RGB-D images, unless the observation
+    # already has them (see src/convert.py).
+    if 'hmap' in obs:
+      cmap, hmap = obs['cmap'], obs['hmap']
+    else:
+      cmap, hmap = utils.get_fused_heightmap(
+          obs, self.cam_config, self.bounds, self.pix_size)
     img = np.concatenate((cmap,
                           hmap[Ellipsis, None],
                           hmap[Ellipsis, None],
@@ -46,12 +50,14 @@ class TransporterAgent:
     assert img.shape == self.in_shape, img.shape
     return img
 
-  def get_sample(self, dataset, augment=True):
+  def get_sample(self, dataset, augment=True, rng=None):
     """Get a dataset sample.
 
     Args:
       dataset: a ravens.Dataset (train or validation)
       augment: if True, perform data augmentation.
+      rng: optional np.random.RandomState used for sampling and augmentation.
+        Defaults to the global generator.
 
     Returns:
       tuple of data for training:
@@ -62,34 +68,38 @@ class TransporterAgent:
       images is desired, it should be done outside this method.
     """
 
-    (obs, act, _, _), _ = dataset.sample()
+    (obs, act, _, _), _ = dataset.sample(rng=rng)
     img = self.get_image(obs)
 
     # Get training labels from data sample.
     p0_xyz, p0_xyzw = act['pose0']
     p1_xyz, p1_xyzw = act['pose1']
-    p0 = utils.xyz_to_pix(p0_xyz, self.bounds, self.pix_size)
+    p0, p1 = (tuple(pix) for pix in utils.xyz_to_pixels(
+        np.array([p0_xyz, p1_xyz]), self.bounds, self.pix_size).tolist())
     p0_theta = -np.float32(utils.quatXYZW_to_eulerXYZ(p0_xyzw)[2])
-    p1 = utils.xyz_to_pix(p1_xyz, self.bounds, self.pix_size)
     p1_theta = -np.float32(utils.quatXYZW_to_eulerXYZ(p1_xyzw)[2])
     p1_theta = p1_theta - p0_theta
     p0_theta = 0
 
     # Data augmentation.
     if augment:
-      img, _, (p0, p1), _ = utils.perturb(img, [p0, p1])
+      img, _, (p0, p1), _ = utils.perturb(img, [p0, p1], rng=rng)
 
     return img, p0, p0_theta, p1, p1_theta
 
-  def train(self, dataset, writer=None):
+  def train(self, dataset, writer=None, sample=None):
     """Train on a dataset sample for 1 iteration.
 
     Args:
       dataset: a ravens.Dataset.
       writer: a TF summary writer (for tensorboard).
+      sample: optional precomputed `get_sample` output (e.g. from a
+        `Prefetcher`). If None, a sample is drawn from `dataset`.
     """
     tf.keras.backend.set_learning_phase(1)
-    img, p0, p0_theta, p1, p1_theta = self.get_sample(dataset)
+    if sample is None:
+      sample = self.get_sample(dataset)
+    img, p0, p0_theta, p1, p1_theta = sample
 
     # Get training losses.
     step = self.total_steps + 1
@@ -170,8 +180,8 @@ class TransporterAgent:
 
     # Pixels to end effector poses.
     hmap = img[:, :, 3]
-    p0_xyz = utils.pix_to_xyz(p0_pix, hmap, self.bounds, self.pix_size)
-    p1_xyz = utils.pix_to_xyz(p1_pix, hmap, self.bounds, self.pix_size)
+    p0_xyz, p1_xyz = utils.pixels_to_xyz(
+        np.array([p0_pix, p1_pix]), hmap, self.bounds, self.pix_size)
     p0_xyzw = utils.eulerXYZ_to_quatXYZW((0, 0, -p0_theta))
     p1_xyzw = utils.eulerXYZ_to_quatXYZW((0, 0, -p1_theta))
 
@@ -200,6 +210,14 @@ class TransporterAgent:
     #   img_goal = input_image[:, :, half:]
     #   place_conf = self.transport.forward(img_curr, img_goal, p0_pix)
 
+  def __getstate__(self):
+    # Pickled agents (e.g. sent to `Prefetcher` worker processes) carry only
+    # what `get_sample` needs, not the models.
+    state = self.__dict__.copy()
+    state.pop('attention', None)
+    state.pop('transport', None)
+    return state
+
   def load(self, n_iter):
     """Load pre-trained models."""
     print(f'Loading pre-trained model at {n_iter} iterations.')
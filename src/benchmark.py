@@ -0,0 +1,482 @@
+"""Micro-benchmarks for data and perception hot paths."""
+
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import timeit
+
+from absl import app
+from absl import flags
+import cv2
+import numpy as np
+import pybullet as p
+from src import dataset
+from src import tasks
+from src.environments.environment import ContinuousEnvironment
+from src.environments.environment import Environment
+from src.tasks import cameras
+from src.utils import codecs
+from src.utils import poses
+from src.utils import utils
+
+flags.DEFINE_string('assets_root', '.', '')
+flags.DEFINE_string('task', 'block-insertion', '')
+flags.DEFINE_list('benchmarks', ['heightmap'], '')
+flags.DEFINE_integer('n_scenes', 3, '')
+flags.DEFINE_integer('repeats', 10, '')
+flags.DEFINE_list('codecs', ['raw', 'depth:uint16_mm', 'color:png',
+                             'color:jpeg:95', 'color:jpeg:75', 'info:zlib',
+                             'action:zlib', 'info:lz4', 'action:lz4'],
+                  'Field codecs of the codecs benchmark; "raw" is the default '
+                  'format.')
+
+FLAGS = flags.FLAGS
+
+
+#-----------------------------------------------------------------------------
+# REFERENCE IMPLEMENTATIONS
+#-----------------------------------------------------------------------------
+
+
+def get_heightmap_argsort(points, colors, bounds, pixel_size, kind='stable'):
+  """Previous `utils.get_heightmap`, z-buffering by sorting all points.
+
+  It used the default (unstable) sort, so points at exactly the same height
+  in the same pixel were resolved in an order depending on the NumPy build.
+  With kind='stable', the last of them in image order wins.
+  """
+  width = int(np.round((bounds[0, 1] - bounds[0, 0]) / pixel_size))
+  height = int(np.round((bounds[1, 1] - bounds[1, 0]) / pixel_size))
+  heightmap = np.zeros((height, width), dtype=np.float32)
+  colormap = np.zeros((height, width, colors.shape[-1]), dtype=np.uint8)
+  ix = (points[Ellipsis, 0] >= bounds[0, 0]) & (points[Ellipsis, 0] < bounds[0, 1])
+  iy = (points[Ellipsis, 1] >= bounds[1, 0]) & (points[Ellipsis, 1] < bounds[1, 1])
+  iz = (points[Ellipsis, 2] >= bounds[2, 0]) & (points[Ellipsis, 2] < bounds[2, 1])
+  valid = ix & iy & iz
+  points = points[valid]
+  colors = colors[valid]
+  iz = np.argsort(points[:, -1], kind=kind)
+  points, colors = points[iz], colors[iz]
+  px = np.int32(np.floor((points[:, 0] - bounds[0, 0]) / pixel_size))
+  py = np.int32(np.floor((points[:, 1] - bounds[1, 0]) / pixel_size))
+  px = np.clip(px, 0, width - 1)
+  py = np.clip(py, 0, height - 1)
+  heightmap[py, px] = points[:, 2] - bounds[2, 0]
+  for c in range(colors.shape[-1]):
+    colormap[py, px, c] = colors[:, c]
+  return heightmap, colormap
+
+
+def get_fused_heightmap_views(obs, configs, bounds, pixel_size):
+  """Previous `utils.get_fused_heightmap`, fusing per-view heightmaps."""
+  heightmaps, colormaps = [], []
+  for color, depth, config in zip(obs['color'], obs['depth'], configs):
+    xyz = cameras.Camera.from_config(config).pointcloud(depth)
+    heightmap, colormap = utils.get_heightmap(xyz, color, bounds, pixel_size)
+    heightmaps.append(heightmap)
+    colormaps.append(colormap)
+  colormaps = np.float32(colormaps)
+  heightmaps = np.float32(heightmaps)
+  valid = np.sum(colormaps, axis=3) > 0
+  repeat = np.sum(valid, axis=0)
+  repeat[repeat == 0] = 1
+  cmap = np.sum(colormaps, axis=0) / repeat[Ellipsis, None]
+  cmap = np.uint8(np.round(cmap))
+  hmap = np.max(heightmaps, axis=0)
+  return cmap, hmap
+
+
+def perturb_sequential(input_image, pixels, rng):
+  """Previous `utils.perturb`, sampling and checking one transform at a time."""
+  image_size = input_image.shape[:2]
+  while True:
+    theta, trans, pivot = utils.get_random_image_transform_params(
+        image_size, rng)
+    transform = utils.get_image_transform(theta, trans, pivot)
+    is_valid = True
+    new_pixels = []
+    new_rounded_pixels = []
+    for pixel in pixels:
+      pixel = np.float32([pixel[1], pixel[0], 1.]).reshape(3, 1)
+      rounded_pixel = np.flip(np.int32(np.round(transform @ pixel))[:2, 0])
+      pixel = np.flip((transform @ pixel)[:2, 0])
+      is_valid = (is_valid and np.all(rounded_pixel >= 0) and
+                  np.all(pixel >= 0) and np.all(rounded_pixel < image_size) and
+                  np.all(pixel < image_size))
+      new_pixels.append(pixel)
+      new_rounded_pixels.append(rounded_pixel)
+    if is_valid:
+      break
+  input_image = cv2.warpAffine(
+      input_image,
+      transform[:2, :], (image_size[1], image_size[0]),
+      flags=cv2.INTER_NEAREST)
+  return input_image, new_pixels, new_rounded_pixels, (theta, trans, pivot)
+
+
+def perturb_one_batch(input_image, pixels, rng):
+  """`utils.perturb` drawing all `PERTURB_BATCH_SIZE` candidates up front."""
+  image_size = input_image.shape[:2]
+  points = [np.float32([pixel[1], pixel[0], 1.]).reshape(3, 1)
+            for pixel in pixels]
+  thetas, transes, pivot = utils.get_random_image_transform_params(
+      image_size, rng, size=utils.PERTURB_BATCH_SIZE)
+  transforms = utils.get_image_transform(thetas, transes, pivot)
+  is_valid, new_pixels, new_rounded_pixels = utils._transform_pixels(  # pylint: disable=protected-access
+      transforms, points, image_size)
+  i = np.argmax(is_valid)
+  input_image = cv2.warpAffine(
+      input_image,
+      transforms[i, :2, :], (image_size[1], image_size[0]),
+      flags=cv2.INTER_NEAREST)
+  return (input_image, [pixel[i] for pixel in new_pixels],
+          [pixel[i] for pixel in new_rounded_pixels],
+          (thetas[i], transes[i], pivot))
+
+
+#-----------------------------------------------------------------------------
+# BENCHMARKS
+#-----------------------------------------------------------------------------
+
+
+def render_scenes(n_scenes):
+  """Renders `n_scenes` task resets.
+
+  Args:
+    n_scenes: number of scenes.
+
+  Returns:
+    (configs, bounds, pixel_size, scenes) tuple, where scenes is a list of
+      first episode steps (obs, act, reward, info) with oracle actions.
+  """
+  env = Environment(FLAGS.assets_root, disp=False, hz=480)
+  task = tasks.names[FLAGS.task]()
+  env.set_task(task)
+  agent = task.oracle(env)
+  scenes = []
+  for seed in range(n_scenes):
+    np.random.seed(seed)
+    env.seed(seed)
+    obs = env.reset()
+    info = env.info
+    scenes.append((obs, agent.act(obs, info), 0, info))
+  env.close()
+  return env.agent_cams, task.bounds, task.pix_size, scenes
+
+
+def timeit_ms(fn):
+  """Best-of-5 average wall time of `fn` in milliseconds."""
+  times = timeit.repeat(fn, number=FLAGS.repeats, repeat=5)
+  return 1e3 * min(times) / FLAGS.repeats
+
+
+def benchmark_heightmap(configs, bounds, pixel_size, scenes):
+  """Scatter-max `utils.get_heightmap` vs. argsort z-buffering."""
+  old_ms, new_ms, ties = [], [], 0
+  for obs, _, _, _ in scenes:
+    for color, depth, config in zip(obs['color'], obs['depth'], configs):
+      intrinsics = np.array(config['intrinsics']).reshape(3, 3)
+      xyz = utils.get_pointcloud(depth, intrinsics)
+      position = np.array(config['position']).reshape(3, 1)
+      rotation = np.array(p.getMatrixFromQuaternion(config['rotation']))
+      transform = np.eye(4)
+      transform[:3, :] = np.hstack((rotation.reshape(3, 3), position))
+      xyz = utils.transform_pointcloud(xyz, transform)
+
+      # Check compatibility before timing.
+      hmap, cmap = utils.get_heightmap(xyz, color, bounds, pixel_size)
+      ref_hmap, ref_cmap = get_heightmap_argsort(xyz, color, bounds, pixel_size)
+      _, unstable_cmap = get_heightmap_argsort(
+          xyz, color, bounds, pixel_size, kind='quicksort')
+      assert np.array_equal(hmap.view(np.uint32), ref_hmap.view(np.uint32))
+      assert np.array_equal(cmap, ref_cmap)
+      ties += np.count_nonzero(np.any(cmap != unstable_cmap, axis=-1))
+
+      old_ms.append(timeit_ms(lambda: get_heightmap_argsort(  # pylint: disable=cell-var-from-loop
+          xyz, color, bounds, pixel_size, kind='quicksort')))
+      new_ms.append(timeit_ms(lambda: utils.get_heightmap(  # pylint: disable=cell-var-from-loop
+          xyz, color, bounds, pixel_size)))
+  print(f'get_heightmap: argsort {np.mean(old_ms):.2f} ms, '
+        f'scatter-max {np.mean(new_ms):.2f} ms '
+        f'({np.mean(old_ms) / np.mean(new_ms):.1f}x) per camera. Bit-exact '
+        'with stable argsort; default argsort picks other colors for '
+        f'{ties} tied pixels.')
+
+
+def benchmark_fusion(configs, bounds, pixel_size, scenes):
+  """Single-pass `utils.get_fused_heightmap` vs. fusing per-view heightmaps."""
+  old_ms, new_ms = [], []
+  for obs, _, _, _ in scenes:
+    cmap, hmap = utils.get_fused_heightmap(obs, configs, bounds, pixel_size)
+    ref_cmap, ref_hmap = get_fused_heightmap_views(
+        obs, configs, bounds, pixel_size)
+    assert np.array_equal(hmap.view(np.uint32), ref_hmap.view(np.uint32))
+    assert np.array_equal(cmap, ref_cmap)
+
+    # Colors with a 4th (segmentation) channel, as in `Task.get_true_image`.
+    segm = [np.uint8(np.arange(d.size).reshape(d.shape) % 251)
+            for d in obs['depth']]
+    color = [np.concatenate((c, s[Ellipsis, None]), axis=2)
+             for c, s in zip(obs['color'], segm)]
+    hmaps, cmaps = utils.reconstruct_heightmaps(
+        color, obs['depth'], configs, bounds, pixel_size)
+    for c, d, config, hmap, cmap in zip(
+        color, obs['depth'], configs, hmaps, cmaps):
+      xyz = cameras.Camera.from_config(config).pointcloud(d)
+      ref_hmap, ref_cmap = get_heightmap_argsort(xyz, c, bounds, pixel_size)
+      assert np.array_equal(hmap.view(np.uint32), ref_hmap.view(np.uint32))
+      assert np.array_equal(cmap, ref_cmap)
+    try:
+      utils.fuse_heightmaps([color[0], obs['color'][1]], obs['depth'][:2],
+                            configs[:2], bounds, pixel_size)
+      raise AssertionError('Mismatched color channels were not rejected.')
+    except ValueError:
+      pass
+
+    old_ms.append(timeit_ms(lambda: get_fused_heightmap_views(  # pylint: disable=cell-var-from-loop
+        obs, configs, bounds, pixel_size)))
+    new_ms.append(timeit_ms(lambda: utils.get_fused_heightmap(  # pylint: disable=cell-var-from-loop
+        obs, configs, bounds, pixel_size)))
+  print(f'get_fused_heightmap: per-view {np.mean(old_ms):.2f} ms, '
+        f'single-pass {np.mean(new_ms):.2f} ms '
+        f'({np.mean(old_ms) / np.mean(new_ms):.1f}x) per observation. '
+        'Bit-exact, also with 4-channel colors.')
+
+
+def benchmark_batch(configs, bounds, pixel_size, scenes):
+  """Batched `utils.get_fused_heightmaps` vs. a loop over observations."""
+  color = np.uint8([obs['color'] for obs, _, _, _ in scenes])
+  depth = np.float32([obs['depth'] for obs, _, _, _ in scenes])
+  def loop():
+    return [utils.get_fused_heightmap(
+        {'color': c, 'depth': d}, configs, bounds, pixel_size)
+            for c, d in zip(color, depth)]
+  cmaps, hmaps = utils.get_fused_heightmaps(
+      color, depth, configs, bounds, pixel_size, chunk_size=len(scenes))
+  for (cmap, hmap), ref_cmap, ref_hmap in zip(loop(), cmaps, hmaps):
+    assert np.array_equal(cmap, ref_cmap)
+    assert np.array_equal(hmap.view(np.uint32), ref_hmap.view(np.uint32))
+  times = [f'loop {timeit_ms(loop) / len(scenes):.2f} ms']
+  chunk_size = 1
+  while chunk_size <= len(scenes):
+    ms = timeit_ms(lambda: utils.get_fused_heightmaps(  # pylint: disable=cell-var-from-loop
+        color, depth, configs, bounds, pixel_size, chunk_size)) / len(scenes)
+    times.append(f'chunk_size={chunk_size} {ms:.2f} ms')
+    chunk_size *= 2
+  print(f'get_fused_heightmaps: {", ".join(times)} per observation of a '
+        f'batch of {len(scenes)}. Bit-exact.')
+
+
+def benchmark_codecs(unused_configs, unused_bounds, unused_pixel_size, scenes):
+  """Stored bytes per step and decode throughput of dataset field codecs."""
+  for item in FLAGS.codecs:
+    field, _, spec = item.partition(':')
+    if field == 'raw':
+      field, spec = None, 'raw'
+    try:
+      codecs.get(spec)
+    except ImportError as e:
+      print(f'{item}: skipped ({e})')
+      continue
+
+    # Write the scenes as one episode, with the codec for one field only.
+    path = tempfile.mkdtemp()
+    ds = dataset.Dataset(path, codecs={field: spec} if field else {})
+    ds.add(0, scenes)
+    nbytes = {}
+    for f in ds.image_fields + dataset.DATA_FIELDS:
+      field_path = os.path.join(path, f)
+      nbytes[f] = sum(os.path.getsize(os.path.join(field_path, fname))
+                      for fname in os.listdir(field_path))
+    field_nbytes = nbytes[field] if field else sum(nbytes.values())
+
+    # Read whole steps; raw memory maps are copied so that they are read too.
+    def load():
+      for step in range(len(scenes)):
+        obs, _, _, _ = ds.load_step(0, step, cache=False)  # pylint: disable=cell-var-from-loop
+        for x in obs.values():
+          if isinstance(x, np.memmap):
+            np.array(x)
+    ms = timeit_ms(load) / len(scenes)
+    shutil.rmtree(path)
+    print(f'{item}: {field_nbytes / len(scenes) / 1e3:.1f} KB/step '
+          f'({sum(nbytes.values()) / len(scenes) / 1e3:.1f} KB/step total), '
+          f'load_step {ms:.2f} ms ({1e3 / ms:.0f} steps/s).')
+
+
+def benchmark_legacy_append(unused_configs, unused_bounds, unused_pixel_size,
+                            scenes):
+  """Appending episodes to a dataset of the format before format files."""
+  # One pickled episode as the original Dataset.add wrote it.
+  path = tempfile.mkdtemp()
+  fields = {
+      'color': np.uint8([obs['color'] for obs, _, _, _ in scenes]),
+      'depth': np.float32([obs['depth'] for obs, _, _, _ in scenes]),
+      'action': [act for _, act, _, _ in scenes],
+      'reward': [reward for _, _, reward, _ in scenes],
+      'info': [info for _, _, _, info in scenes],
+  }
+  for field, data in fields.items():
+    os.makedirs(os.path.join(path, field))
+    with open(os.path.join(path, field, '000000-0.pkl'), 'wb') as f:
+      pickle.dump(data, f)
+
+  # Append record episodes, reopening the dataset in between as a dataset of
+  # record episodes without a format file.
+  ds = dataset.Dataset(path)
+  ms = timeit_ms(lambda: dataset.Dataset(path).add(1, scenes)) / len(scenes)
+  ds.refresh()
+  assert not os.path.exists(os.path.join(path, dataset.FORMAT_FNAME))
+  for episode_id in range(ds.n_episodes):
+    episode, _ = ds.load(episode_id)
+    for (obs, act, reward, info), ref in zip(episode, scenes):
+      for key in obs:
+        assert np.array_equal(obs[key], ref[0][key])
+      assert pickle.dumps((act, reward, info)) == pickle.dumps(ref[1:])
+  shutil.rmtree(path)
+  print(f'legacy append: {ds.n_episodes - 1} episodes appended to a pickled '
+        f'dataset, {ms:.2f} ms per step. Round trip exact.')
+
+
+def benchmark_poses(unused_configs, unused_bounds, unused_pixel_size,
+                    unused_scenes, n_poses=1000):
+  """Batched `poses` transforms vs. one pybullet call per pose."""
+  rng = np.random.RandomState(0)
+  quaternion = rng.randn(2, n_poses, 4)
+  quaternion /= np.linalg.norm(quaternion, axis=-1, keepdims=True)
+  pose0, pose1 = poses.pack(rng.randn(2, n_poses, 3), quaternion)
+  def invert_loop():
+    return [p.invertTransform(x[:3], x[3:]) for x in pose0]
+  def multiply_loop():
+    return [p.multiplyTransforms(x[:3], x[3:], y[:3], y[3:])
+            for x, y in zip(pose0, pose1)]
+  for ref, pose in [(invert_loop(), poses.invert(pose0)),
+                    (multiply_loop(), poses.multiply(pose0, pose1))]:
+    assert np.array_equal(np.float64([np.concatenate(x) for x in ref]), pose)
+  times = []
+  for name, loop, batch in [
+      ('invert', invert_loop, lambda: poses.invert(pose0)),
+      ('multiply', multiply_loop, lambda: poses.multiply(pose0, pose1))]:
+    times.append(f'{name} {1e3 * timeit_ms(loop) / n_poses:.2f} vs. '
+                 f'{1e3 * timeit_ms(batch) / n_poses:.2f} us')
+  print(f'poses (pybullet loop vs. batch of {n_poses}): {", ".join(times)} '
+        'per pose. Bit-exact.')
+
+
+def benchmark_perturb(unused_configs, bounds, pixel_size, scenes,
+                      n_samples=100):
+  """Batched `utils.perturb` vs. checking one transform at a time."""
+  image = np.zeros((320, 160, 6), dtype=np.float32)
+  labels = [[tuple(pixel) for pixel in utils.xyz_to_pixels(
+      [act['pose0'][0], act['pose1'][0]], bounds, pixel_size).tolist()]
+            for _, act, _, _ in scenes]
+  def run(perturb):
+    return [perturb(image, labels[i % len(labels)],
+                    rng=np.random.RandomState(i)) for i in range(n_samples)]
+  for result, ref_result in zip(run(utils.perturb), run(perturb_sequential)):
+    assert np.array_equal(result[0], ref_result[0])
+    for x, y in zip(result[1] + result[2], ref_result[1] + ref_result[2]):
+      assert np.array_equal(x, y)
+    assert result[3][0] == ref_result[3][0]
+    assert np.array_equal(result[3][1], ref_result[3][1])
+
+  # Labels no transform keeps in the image end the search with the identity.
+  result = utils.perturb(image + 1, [(-10, -10), (329, 169)])
+  assert np.array_equal(result[0], image + 1)
+  assert result[3][0] == 0 and not np.any(result[3][1])
+
+  old_ms = timeit_ms(lambda: run(perturb_sequential)) / n_samples
+  one_batch_ms = timeit_ms(lambda: run(perturb_one_batch)) / n_samples
+  new_ms = timeit_ms(lambda: run(utils.perturb)) / n_samples
+  print(f'perturb: sequential {old_ms:.2f} ms, one batch of '
+        f'{utils.PERTURB_BATCH_SIZE} {one_batch_ms:.2f} ms, doubling batches '
+        f'{new_ms:.2f} ms ({old_ms / new_ms:.1f}x) per sample of '
+        f'{len(labels)} scenes\' labels. Same transforms.')
+
+
+def benchmark_lazy_obs(unused_configs, unused_bounds, unused_pixel_size,
+                       scenes, steps_per_seg=3):
+  """Oracle episodes with eager, read lazy and unread lazy observations."""
+  def run(continuous, lazy_obs, read):
+    env_cls = ContinuousEnvironment if continuous else Environment
+    env = env_cls(FLAGS.assets_root, disp=False, hz=480, lazy_obs=lazy_obs)
+    task = tasks.names[FLAGS.task](continuous=continuous)
+    env.set_task(task)
+    agent = task.oracle(env, steps_per_seg=steps_per_seg)
+    max_steps = task.max_steps
+    if continuous:
+      max_steps *= steps_per_seg * agent.num_poses
+    n_renders = [0]
+    get_obs = env._get_obs  # pylint: disable=protected-access
+    def counted_get_obs():
+      n_renders[0] += 1
+      return get_obs()
+    env._get_obs = counted_get_obs  # pylint: disable=protected-access
+    observations = []
+    start = time.time()
+    for seed in range(len(scenes)):
+      np.random.seed(seed)
+      env.seed(seed)
+      obs, info = env.reset(), env.info
+      first_obs = obs
+      for _ in range(max_steps):
+        if read:
+          observations.append(dict(obs))
+        obs, _, done, info = env.step(agent.act(obs, info))
+        if done:
+          break
+    ms = 1e3 * (time.time() - start) / len(scenes)
+    env.close()
+    return observations, n_renders[0], ms, first_obs
+
+  results = []
+  for continuous in (False, True):
+    observations, eager_renders, eager_ms, _ = run(continuous, False, True)
+    lazy_observations, lazy_renders, _, _ = run(continuous, True, True)
+    _, unread_renders, unread_ms, first_obs = run(continuous, True, False)
+
+    # Read lazy observations are the eager ones; unread ones are never
+    # rendered and can not be read after the next step.
+    assert lazy_renders == len(observations) == eager_renders - len(scenes)
+    for obs, lazy_obs in zip(observations, lazy_observations):
+      for key in obs:
+        for x, y in zip(obs[key], lazy_obs[key]):
+          assert np.array_equal(x, y)
+    assert unread_renders == 0
+    try:
+      first_obs.render()
+      raise AssertionError('Read an observation after the next step.')
+    except ValueError:
+      pass
+    results.append(f'{"continuous" if continuous else "discrete"} '
+                   f'{eager_ms:.0f} vs. {unread_ms:.0f} ms '
+                   f'({eager_renders} vs. 0 renders)')
+  print(f'lazy_obs (eager vs. unread lazy oracle episodes): '
+        f'{", ".join(results)} per episode. Read lazy observations are the '
+        'eager ones.')
+
+
+BENCHMARKS = {
+    'heightmap': benchmark_heightmap,
+    'fusion': benchmark_fusion,
+    'batch': benchmark_batch,
+    'codecs': benchmark_codecs,
+    'legacy_append': benchmark_legacy_append,
+    'poses': benchmark_poses,
+    'perturb': benchmark_perturb,
+    'lazy_obs': benchmark_lazy_obs,
+}
+
+
+def main(unused_argv):
+  configs, bounds, pixel_size, scenes = render_scenes(FLAGS.n_scenes)
+  print(f'{FLAGS.task}: {len(scenes)} scenes, {len(configs)} cameras, '
+        f'{os.cpu_count()} CPUs.')
+  for name in FLAGS.benchmarks:
+    BENCHMARKS[name](configs, bounds, pixel_size, scenes)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,154 @@
+"""Parallel data collection script: oracle demonstrations in worker processes."""
+
+import collections
+from concurrent import futures
+import multiprocessing
+import os
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+from src import tasks
+from src.dataset import Dataset
+from src.environments.environment import ContinuousEnvironment
+from src.environments.environment import Environment
+from src.utils import codecs
+
+flags.DEFINE_string('assets_root', '.', '')
+flags.DEFINE_string('data_dir', './dataset', '')
+flags.DEFINE_string('task', 'block-insertion', '')
+flags.DEFINE_string('mode', 'train', '')
+flags.DEFINE_integer('n', 1000, '')
+flags.DEFINE_integer('n_workers', os.cpu_count(), '')
+flags.DEFINE_bool('continuous', False, '')
+flags.DEFINE_integer('steps_per_seg', 3, '')
+flags.DEFINE_bool('fast_reset', False, 'Restore a scene snapshot on reset.')
+flags.DEFINE_bool('lazy_obs', False, 'Skip rendering unread observations.')
+flags.DEFINE_bool('orthographic_oracle', False, 'Render oracle heightmaps '
+                  'with an orthographic camera. Faster, but seeds produce '
+                  'other scenes than in datasets collected without it.')
+flags.DEFINE_list('codecs', [], 'Field codecs of a new dataset, e.g. '
+                  'depth:uint16_mm,color:png,info:zlib.')
+
+FLAGS = flags.FLAGS
+
+# Environment, oracle and dataset of a worker process.
+_worker = None
+
+Worker = collections.namedtuple(
+    'Worker', ['env', 'task', 'agent', 'dataset', 'max_steps', 'first_seed'])
+
+# Outcome of one demonstration attempt. `episode_id` is None if it failed.
+Result = collections.namedtuple(
+    'Result', ['pid', 'seed', 'episode_id', 'busy_time'])
+
+
+def _init_worker(assets_root, path, task_name, mode, continuous, steps_per_seg,
+                 fast_reset, lazy_obs, orthographic_oracle, codec_specs):
+  """Builds the environment, oracle and dataset of a worker process."""
+  global _worker
+  env_cls = ContinuousEnvironment if continuous else Environment
+  env = env_cls(assets_root, disp=False, hz=480, fast_reset=fast_reset,
+                lazy_obs=lazy_obs)
+  task = tasks.names[task_name](continuous=continuous)
+  task.mode = mode
+  task.orthographic_oracle = orthographic_oracle
+  agent = task.oracle(env, steps_per_seg=steps_per_seg)
+  max_steps = task.max_steps
+  if continuous:
+    max_steps *= (steps_per_seg * agent.num_poses)
+
+  # Train seeds are even and test seeds are odd.
+  first_seed = 1 if (mode == 'test') else 0
+  _worker = Worker(env, task, agent, Dataset(path, codecs=codec_specs),
+                   max_steps, first_seed)
+
+
+def collect_episode():
+  """Runs one oracle demonstration with the next free seed of the dataset.
+
+  Seeds are reserved through the shared dataset (see `Dataset.reserve_seed`),
+  so workers claim disjoint shards of the seed sequence in the order they ask
+  for them, and a restarted run continues after the last reserved seed.
+
+  Returns:
+    `Result` of the attempt. Only successful demonstrations are committed.
+  """
+  start = time.time()
+  env, task, agent, dataset, max_steps, first_seed = _worker
+  seed = dataset.reserve_seed(first_seed)
+  np.random.seed(seed)
+  env.set_task(task)
+  obs = env.reset()
+  info = None
+  reward = 0
+  total_reward = 0
+  episode_id = None
+  with dataset.writer(seed) as writer:
+    for _ in range(max_steps):
+      act = agent.act(obs, info)
+      writer.append(obs, act, reward, info)
+      obs, reward, done, info = env.step(act)
+      total_reward += reward
+      if done:
+        break
+    # The last observation of a failed demonstration is never saved.
+    if total_reward > 0.99:
+      writer.append(obs, None, reward, info)
+      episode_id = writer.commit()
+  return Result(os.getpid(), seed, episode_id, time.time() - start)
+
+
+def main(unused_argv):
+  path = os.path.join(FLAGS.data_dir, f'{FLAGS.task}-{FLAGS.mode}')
+  dataset = Dataset(path)
+  n_start = dataset.n_episodes
+  print(f'{path}: {n_start} demonstrations, collecting {FLAGS.n}.')
+
+  ctx = multiprocessing.get_context('spawn')
+  initargs = (FLAGS.assets_root, path, FLAGS.task, FLAGS.mode,
+              FLAGS.continuous, FLAGS.steps_per_seg, FLAGS.fast_reset,
+              FLAGS.lazy_obs, FLAGS.orthographic_oracle,
+              codecs.parse_field_specs(FLAGS.codecs))
+  start = time.time()
+  n_attempts, n_success = 0, 0
+  busy_time = collections.defaultdict(float)
+  with futures.ProcessPoolExecutor(
+      FLAGS.n_workers, mp_context=ctx, initializer=_init_worker,
+      initargs=initargs) as executor:
+    pending = set()
+    while True:
+      # Keep every worker busy, but never attempt more demonstrations than
+      # are missing, counting those of other writers to the same dataset.
+      dataset.refresh()
+      while (len(pending) < FLAGS.n_workers and
+             dataset.n_episodes + len(pending) < FLAGS.n):
+        pending.add(executor.submit(collect_episode))
+      if not pending:
+        break
+      done, pending = futures.wait(
+          pending, return_when=futures.FIRST_COMPLETED)
+      for future in done:
+        result = future.result()
+        n_attempts += 1
+        busy_time[result.pid] += result.busy_time
+        if result.episode_id is None:
+          print(f'Seed {result.seed}: failed.')
+          continue
+        n_success += 1
+        elapsed = time.time() - start
+        print(f'Seed {result.seed}: demonstration {result.episode_id + 1}/'
+              f'{FLAGS.n}, {n_success / elapsed:.2f} demos/s, '
+              f'{n_success / n_attempts:.0%} success rate.')
+
+  elapsed = time.time() - start
+  print(f'Collected {n_success} demonstrations in {elapsed:.1f}s '
+        f'({n_success / elapsed:.2f} demos/s), {n_success}/{n_attempts} '
+        'successful attempts.')
+  for i, (pid, busy) in enumerate(sorted(busy_time.items())):
+    print(f'Worker {i} (pid {pid}): {busy / elapsed:.0%} utilization.')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,77 @@
+"""Dataset conversion script: RGB-D views to fused heightmaps."""
+
+from concurrent import futures
+import multiprocessing
+import os
+
+from absl import app
+from absl import flags
+import numpy as np
+from src import dataset
+from src.utils import codecs
+from src.utils import utils
+
+flags.DEFINE_string('data_dir', './dataset', '')
+flags.DEFINE_string('out_dir', './dataset-heightmaps', '')
+flags.DEFINE_string('task', 'block-insertion', '')
+flags.DEFINE_string('mode', 'train', '')
+flags.DEFINE_integer('n_workers', os.cpu_count(), '')
+flags.DEFINE_bool('keep_views', False, 'Also copy the RGB-D views.')
+flags.DEFINE_list('codecs', [], 'Field codecs of the output dataset, e.g. '
+                  'hmap:uint16_mm,cmap:png.')
+
+FLAGS = flags.FLAGS
+
+# Source dataset of a worker process.
+_dataset = None
+
+
+def _init_worker(path):
+  global _dataset
+  _dataset = dataset.Dataset(path)
+
+
+def fuse_episode(episode_id):
+  """Fuse the camera views of every step of an episode into heightmaps.
+
+  Args:
+    episode_id: ID of the episode in the worker's source dataset.
+
+  Returns:
+    (cmaps, hmaps) tuple of TxHxWx3 uint8 colormaps and TxHxW float32
+      heightmaps, as computed by `TransporterAgent.get_image`.
+  """
+  episode, _ = _dataset.load(episode_id, cache=False)
+  color = np.uint8([obs['color'] for obs, _, _, _ in episode])
+  depth = np.float32([obs['depth'] for obs, _, _, _ in episode])
+  return utils.get_fused_heightmaps(color, depth, dataset.CAMERA_CONFIG,
+                                    dataset.BOUNDS, dataset.PIXEL_SIZE)
+
+
+def main(unused_argv):
+  name = f'{FLAGS.task}-{FLAGS.mode}'
+  in_path = os.path.join(FLAGS.data_dir, name)
+  src = dataset.Dataset(in_path)
+  dst = dataset.Dataset(os.path.join(FLAGS.out_dir, name),
+                        codecs=codecs.parse_field_specs(FLAGS.codecs))
+
+  # Episodes keep their IDs, so a partial conversion resumes where it stopped.
+  episode_ids = range(dst.n_episodes, src.n_episodes)
+  ctx = multiprocessing.get_context('spawn')
+  with futures.ProcessPoolExecutor(
+      FLAGS.n_workers, mp_context=ctx, initializer=_init_worker,
+      initargs=(in_path,)) as executor:
+    results = executor.map(fuse_episode, episode_ids)
+    for episode_id, (cmaps, hmaps) in zip(episode_ids, results):
+      episode = []
+      for step, (cmap, hmap) in enumerate(zip(cmaps, hmaps)):
+        obs, act, reward, info = src.load_step(
+            episode_id, step, images=FLAGS.keep_views, cache=False)
+        obs = dict(obs, cmap=cmap, hmap=hmap)
+        episode.append((obs, act, reward, info))
+      dst.add(src.episode_seed(episode_id), episode)
+      print(f'Converted episode: {episode_id + 1}/{src.n_episodes}')
+
+
+if __name__ == '__main__':
+  app.run(main)
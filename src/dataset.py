@@ -1,11 +1,22 @@
 """Image dataset."""
 
+import collections
+from concurrent import futures
+import contextlib
+import fcntl
+import json
+import multiprocessing
 import os
 import pickle
+import socket
+import sys
+import threading
+import uuid
 
 import numpy as np
 from src import tasks
 from src.tasks import cameras
+from src.utils import codecs
 import tensorflow as tf
 
 # See transporter.py, regression.py, dummy.py, task.py, etc.
@@ -17,27 +28,495 @@ BOUNDS = np.array([[0.25, 0.75], [-0.5, 0.5], [0, 0.28]])
 TASK_NAMES = (tasks.names).keys()
 TASK_NAMES = sorted(TASK_NAMES)[::-1]
 
+# Episode fields, each stored in its own subdirectory. Observations hold the
+# RGB-D views of the agent cameras ('color', 'depth'), their fused top-down
+# colormap and heightmap ('cmap', 'hmap', see src/convert.py), or both.
+IMAGE_FIELDS = ('color', 'depth', 'cmap', 'hmap')
+DATA_FIELDS = ('action', 'reward', 'info')
+
+# Field storage layouts, recorded in the dataset's format file:
+#   'record': per-step encoded items with random access (see `write_record`).
+#   'array': one .npy block of shape (length,) + step shape per episode, read
+#     through memory maps. Datasets without a format file store every field as
+#     records.
+# Each field also records its codec (see src/utils/codecs.py), which sets its
+# layout: e.g. 'uint16_mm' depth arrays or 'png' color records. Fields without
+# one use DEFAULT_CODECS.
+FORMAT_FNAME = 'format.json'
+ARRAY_FIELDS = {'color': np.uint8, 'depth': np.float32, 'cmap': np.uint8,
+                'hmap': np.float32}
+DEFAULT_CODECS = {'array': 'raw', 'record': 'pickle'}
+
+# Episode index: one fixed-size row per episode, in episode ID order. 'offsets'
+# is the position in the offsets file of the record offsets of the episode,
+# length + 1 per record field in field order, or -1 for older .pkl episodes.
+INDEX_FNAME = 'index.bin'
+OFFSETS_FNAME = 'offsets.bin'
+INDEX_DTYPE = np.dtype([('id', '<i8'), ('seed', '<i8'), ('length', '<i8'),
+                        ('offsets', '<i8')])
+
+# Several processes can write to a dataset at once. Episode IDs, seeds, the
+# index and the format file are only updated while holding an exclusive lock
+# on LOCK_FNAME; episode files are renamed into place under it. Readers of the
+# index hold a shared lock. SEED_FNAME holds the last seed reserved by any
+# writer (see `Dataset.reserve_seed`).
+LOCK_FNAME = '.lock'
+SEED_FNAME = 'seed.txt'
+
+
+def write_record(path, items, codec=None):
+  """Write a list of items to a record file with per-item random access.
+
+  Items are encoded back to back, followed by a footer with the int64 byte
+  offset of every item, the end offset and the int64 number of items.
+
+  Args:
+    path: file path.
+    items: list of items.
+    codec: record codec of the items. Defaults to pickling.
+
+  Returns:
+    int64 array of the len(items) + 1 item offsets.
+  """
+  writer = RecordWriter(path, codec)
+  for item in items:
+    writer.write(item)
+  return writer.close()
+
+
+def read_record_offsets(f):
+  """Read the item offsets from the footer of an open record file."""
+  f.seek(-8, os.SEEK_END)
+  n_items = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+  f.seek(-8 * (n_items + 2), os.SEEK_END)
+  return np.frombuffer(f.read(8 * (n_items + 1)), dtype=np.int64)
+
+
+def read_record_item(f, offsets, i, codec=None):
+  """Read the i-th item of an open record file."""
+  codec = codecs.Pickle() if codec is None else codec
+  f.seek(offsets[i])
+  return codec.decode(f.read(offsets[i + 1] - offsets[i]))
+
+
+def write_atomic(path, data):
+  """Write bytes to a file through a temporary file and a rename."""
+  tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(data)
+  os.replace(tmp_path, path)
+
+
+def writer_tmp_fname():
+  """Temporary file name of an episode writer, tagged with host and pid."""
+  return f'.{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}.tmp'
+
+
+def is_stale_writer_tmp(fname):
+  """True for a `writer_tmp_fname` of a process on this host that died."""
+  parts = fname[1:-len('.tmp')].rsplit('-', 2)
+  if len(parts) != 3 or parts[0] != socket.gethostname():
+    return False
+  try:
+    os.kill(int(parts[1]), 0)
+  except ProcessLookupError:
+    return True
+  except (ValueError, PermissionError):
+    pass
+  return False
+
+
+def read_array(path, dtype):
+  """Memory-map a binary array file, or return an empty array if missing."""
+  if not os.path.exists(path) or os.path.getsize(path) == 0:
+    return np.zeros(0, dtype=dtype)
+  return np.memmap(path, dtype=dtype, mode='r')
+
+
+class RecordWriter:
+  """Writes a record file one item at a time (see `write_record`)."""
+
+  def __init__(self, path, codec=None):
+    self.path = path
+    self.codec = codecs.Pickle() if codec is None else codec
+    self.offsets = [0]
+    self._file = open(path, 'wb')
+
+  def write(self, item):
+    self.offsets.append(self.offsets[-1] + self._file.write(
+        self.codec.encode(item)))
+
+  def close(self):
+    """Writes the footer and returns the item offsets."""
+    offsets = np.int64(self.offsets)
+    self._file.write(np.int64(self.offsets + [len(offsets) - 1]).tobytes())
+    self._file.close()
+    return offsets
+
+  def abort(self):
+    """Closes and deletes the file."""
+    self._file.close()
+    os.remove(self.path)
+
+
+# Size of the .npy headers written by `ArrayWriter`, large enough for any
+# length and a multiple of 64 to keep the data aligned.
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(dtype, shape):
+  """Version 1.0 .npy file header of a C-order array, padded to a fixed size."""
+  header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                 'fortran_order': False, 'shape': tuple(shape)})
+  header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+  if len(header) != NPY_HEADER_SIZE - 10:
+    raise ValueError(f'.npy header of shape {shape} is too long.')
+  size = np.array(len(header), dtype='<u2').tobytes()
+  return b'\x93NUMPY\x01\x00' + size + header.encode('latin1')
+
+
+class ArrayWriter:
+  """Writes a .npy array one step (slice along the first axis) at a time.
+
+  The header is rewritten with the final length on close, so the file can be
+  loaded with `np.load` like one written by `np.save`.
+  """
+
+  def __init__(self, path, dtype, step_shape):
+    self.path = path
+    self.dtype = np.dtype(dtype)
+    self.step_shape = tuple(step_shape)
+    self.length = 0
+    self._file = open(path, 'wb')
+    self._file.write(npy_header(self.dtype, (0,) + self.step_shape))
+
+  def write(self, x):
+    x = np.ascontiguousarray(x, dtype=self.dtype)
+    if x.shape != self.step_shape:
+      raise ValueError(f'Expected shape {self.step_shape}, got {x.shape}.')
+    self._file.write(x.data)
+    self.length += 1
+
+  def close(self):
+    """Writes the final header and returns the number of steps."""
+    self._file.seek(0)
+    self._file.write(npy_header(self.dtype, (self.length,) + self.step_shape))
+    self._file.close()
+    return self.length
+
+  def abort(self):
+    """Closes and deletes the file."""
+    self._file.close()
+    os.remove(self.path)
+
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'nbytes', 'max_bytes',
+                  'entries'])
+
+
+def data_nbytes(data):
+  """Approximate size of loaded episode data in bytes.
+
+  Memory-mapped arrays count by their mapped size. Their pages live in the OS
+  page cache, but counting them lets a cache budget bound how many mappings
+  stay open.
+  """
+  if isinstance(data, np.ndarray):
+    return data.nbytes
+  if isinstance(data, (list, tuple)):
+    return sum(data_nbytes(x) for x in data)
+  if isinstance(data, dict):
+    return sum(data_nbytes(x) for x in data.values())
+  return sys.getsizeof(data)
+
+
+class FieldCache:
+  """LRU cache of loaded episode fields with a byte budget.
+
+  Entries are keyed by (episode_id, field). Once their total size exceeds the
+  budget, least recently used entries are evicted, except those of pinned
+  episodes.
+  """
+
+  def __init__(self, max_bytes=None):
+    """Creates an empty cache.
+
+    Args:
+      max_bytes: byte budget, or None for an unbounded cache.
+    """
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.nbytes = 0
+    self._entries = collections.OrderedDict()  # key: (data, nbytes)
+    self._pinned = set()
+    self._lock = threading.Lock()
+
+  def __getstate__(self):
+    # Copies (e.g. in sampling worker processes) start empty.
+    return {'max_bytes': self.max_bytes, 'pinned': self._pinned}
+
+  def __setstate__(self, state):
+    self.__init__(state['max_bytes'])
+    self._pinned = state['pinned']
+
+  def get(self, key):
+    """Returns cached data for a key, or None if it is not cached."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, data):
+    """Caches data for a key, evicting older entries if over budget."""
+    nbytes = data_nbytes(data)
+    with self._lock:
+      if key in self._entries:
+        self.nbytes -= self._entries.pop(key)[1]
+      self._entries[key] = (data, nbytes)
+      self.nbytes += nbytes
+      self._evict()
+
+  def pin(self, episode_ids):
+    """Exempts the entries of these episodes from eviction."""
+    with self._lock:
+      self._pinned = {int(i) for i in episode_ids}
+      self._evict()
+
+  def _evict(self):
+    if self.max_bytes is None:
+      return
+    for key in list(self._entries):
+      if self.nbytes <= self.max_bytes:
+        break
+      if key[0] not in self._pinned:
+        self.nbytes -= self._entries.pop(key)[1]
+        self.evictions += 1
+
+  def info(self):
+    return CacheInfo(self.hits, self.misses, self.evictions, self.nbytes,
+                     self.max_bytes, len(self._entries))
+
 
 class Dataset:
   """A simple image dataset class."""
 
-  def __init__(self, path):
-    """A simple RGB-D image dataset."""
+  def __init__(self, path, cache_bytes=None, codecs=None):
+    """A simple RGB-D image dataset.
+
+    Args:
+      path: dataset directory.
+      cache_bytes: byte budget of the cache of loaded fields, in which
+        memory-mapped fields count by their mapped size. If set, `load`,
+        `load_step` and `sample` use the cache by default.
+      codecs: optional dict of field names to codec specs (e.g.
+        {'depth': 'uint16_mm', 'color': 'png', 'info': 'zlib'}) of a new
+        dataset. Existing datasets keep the codecs of their format file.
+    """
+    codecs = codecs or {}
+    unknown = set(codecs) - set(IMAGE_FIELDS + DATA_FIELDS)
+    if unknown:
+      raise ValueError(f'Unknown fields: {sorted(unknown)}')
+    self._codec_specs = codecs
     self.path = path
     self.sample_set = []
     self.max_seed = -1
     self.n_episodes = 0
 
-    # Track existing dataset if it exists.
-    color_path = os.path.join(self.path, 'action')
-    if tf.io.gfile.exists(color_path):
-      for fname in sorted(tf.io.gfile.listdir(color_path)):
-        if '.pkl' in fname:
-          seed = int(fname[(fname.find('-') + 1):-4])
-          self.n_episodes += 1
-          self.max_seed = max(self.max_seed, seed)
+    # Track existing dataset if it exists. New datasets get their format when
+    # the first episode is added.
+    self._format = None
+    self.image_fields = ()
+    self._cleaned = False
+    self._memory_index = None
+    format_path = os.path.join(self.path, FORMAT_FNAME)
+    if tf.io.gfile.exists(format_path):
+      with tf.io.gfile.GFile(format_path, 'r') as f:
+        self._set_format(json.load(f))
+    elif tf.io.gfile.exists(os.path.join(self.path, 'action')):
+      self._set_format({})
+
+    # Datasets written before the episode index existed get it built once
+    # from their file names. Read-only ones (e.g. on read-only mounts) keep
+    # it in memory instead.
+    if (self._format is not None and
+        not tf.io.gfile.exists(os.path.join(self.path, INDEX_FNAME))):
+      if os.access(self.path, os.W_OK):
+        with self._locked():
+          if not tf.io.gfile.exists(os.path.join(self.path, INDEX_FNAME)):
+            self._append_index(*self._scan_index())
+      else:
+        rows, offsets = self._scan_index()
+        self._memory_index = (np.array(rows, dtype=INDEX_DTYPE),
+                              np.int64(offsets))
+    self.refresh()
+
+    self._cache = FieldCache(cache_bytes)
+    self._cache_by_default = cache_bytes is not None
+
+  def __getstate__(self):
+    # Memory maps are reopened rather than copied.
+    state = self.__dict__.copy()
+    del state['_index'], state['_index_offsets']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.refresh()
 
-    self._cache = {}
+  @contextlib.contextmanager
+  def _locked(self, shared=False):
+    """Hold the dataset's lock file.
+
+    Writers hold it exclusively. The first time a Dataset does, it also
+    deletes temporary files that crashed writers left behind.
+
+    Readers of the index hold it shared, so they never see a half-appended
+    index. Directories that do not exist yet, or whose lock file cannot be
+    created (e.g. read-only copies), are read without it.
+
+    Args:
+      shared: take a shared instead of an exclusive lock.
+    """
+    lock_path = os.path.join(self.path, LOCK_FNAME)
+    if shared:
+      try:
+        f = open(lock_path, 'a') if os.path.isdir(self.path) else None
+      except OSError:
+        f = None
+      if f is None:
+        yield
+        return
+    else:
+      if not tf.io.gfile.exists(self.path):
+        tf.io.gfile.makedirs(self.path)
+      f = open(lock_path, 'a')
+    with f:
+      fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+      try:
+        if not (shared or self._cleaned):
+          self._remove_stale_tmp_files()
+          self._cleaned = True
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def _remove_stale_tmp_files(self):
+    """Delete temporary files of crashed writers.
+
+    Must be called with the dataset locked exclusively. `write_atomic` files
+    are only written under the lock, so any left over are stale. Episode
+    writers stream outside of it, so their files are only deleted once their
+    process is gone (see `is_stale_writer_tmp`).
+    """
+    for fname in os.listdir(self.path):
+      path = os.path.join(self.path, fname)
+      if fname.endswith('.tmp'):
+        os.remove(path)
+      elif fname in IMAGE_FIELDS + DATA_FIELDS and os.path.isdir(path):
+        for field_fname in os.listdir(path):
+          if (field_fname.endswith('.tmp') and
+              is_stale_writer_tmp(field_fname)):
+            os.remove(os.path.join(path, field_fname))
+
+  def refresh(self):
+    """Pick up episodes added by other writers since the last refresh."""
+    with self._locked(shared=True):
+      self._read_index()
+
+  def reserve_seed(self, first, step=2):
+    """Reserve a seed for a new episode, unique across writers.
+
+    Seeds are reserved in the sequence first, first + step, ..., after the
+    largest seed of the dataset's episodes or reserved by any writer, so
+    parallel writers never collect the same episode.
+
+    Args:
+      first: first seed of the sequence.
+      step: seed increment, e.g. 2 to keep train seeds even and test seeds
+        odd.
+
+    Returns:
+      the reserved seed.
+    """
+    path = os.path.join(self.path, SEED_FNAME)
+    with self._locked():
+      self._read_index()
+      last = first - step
+      if self.n_episodes:
+        last = max(last, self.max_seed)
+      if os.path.exists(path):
+        with open(path, 'r') as f:
+          last = max(last, int(f.read()))
+      seed = last + step
+      write_atomic(path, str(seed).encode())
+    return seed
+
+  def _read_index(self):
+    """Memory-map the episode index and record offsets.
+
+    Must be called with the dataset locked, e.g. through `refresh`.
+    """
+    if self._memory_index is not None:
+      self._index, self._index_offsets = self._memory_index
+    else:
+      self._index = read_array(os.path.join(self.path, INDEX_FNAME),
+                               INDEX_DTYPE)
+      self._index_offsets = read_array(
+          os.path.join(self.path, OFFSETS_FNAME), np.int64)
+    self.n_episodes = len(self._index)
+    if self.n_episodes:
+      self.max_seed = int(self._index['seed'].max())
+
+  def _append_index(self, rows, offsets):
+    """Append episode rows and their record offsets to the index files.
+
+    Must be called with the dataset locked, after `_read_index`.
+    """
+    with open(os.path.join(self.path, OFFSETS_FNAME), 'ab') as f:
+      f.write(np.int64(offsets).tobytes())
+    with open(os.path.join(self.path, INDEX_FNAME), 'ab') as f:
+      f.write(np.array(rows, dtype=INDEX_DTYPE).tobytes())
+    self._read_index()
+
+  def _scan_index(self):
+    """Build the episode index from one listing of the episode files.
+
+    Episodes are either record files (.rec), whose offsets are read from their
+    footers, or pickled whole-episode lists from older datasets (.pkl).
+
+    Returns:
+      (rows, offsets) of the index, see `_append_index`.
+    """
+    rows, offsets = [], []
+    n_offsets = 0
+    action_path = os.path.join(self.path, 'action')
+    for fname in sorted(tf.io.gfile.listdir(action_path)):
+      if not (fname.endswith('.pkl') or fname.endswith('.rec')):
+        continue
+      episode_id = int(fname[:fname.find('-')])
+      seed = int(fname[(fname.find('-') + 1):-4])
+      if fname.endswith('.pkl'):
+        with open(os.path.join(action_path, fname), 'rb') as f:
+          rows.append((episode_id, seed, len(pickle.load(f)), -1))
+        continue
+      for field in self._record_fields():
+        with open(os.path.join(self.path, field, fname), 'rb') as f:
+          offsets.append(read_record_offsets(f))
+      length = len(offsets[-1]) - 1
+      rows.append((episode_id, seed, length, n_offsets))
+      n_offsets += len(self._record_fields()) * (length + 1)
+    rows.sort()
+    if [row[0] for row in rows] != list(range(len(rows))):
+      raise ValueError(f'Episode IDs in {self.path} are not contiguous.')
+    offsets = np.concatenate(offsets) if offsets else []
+    return rows, offsets
 
   def add(self, seed, episode):
     """Add an episode to the dataset.
@@ -46,109 +525,444 @@ class Dataset:
       seed: random seed used to initialize the episode.
       episode: list of (obs, act, reward, info) tuples.
     """
-    color, depth, action, reward, info = [], [], [], [], []
-    for obs, act, r, i in episode:
-      color.append(obs['color'])
-      depth.append(obs['depth'])
-      action.append(act)
-      reward.append(r)
-      info.append(i)
-
-    color = np.uint8(color)
-    depth = np.float32(depth)
-
-    def dump(data, field):
-      field_path = os.path.join(self.path, field)
-      if not tf.io.gfile.exists(field_path):
-        tf.io.gfile.makedirs(field_path)
-      fname = f'{self.n_episodes:06d}-{seed}.pkl'  # -{len(episode):06d}
-      with tf.io.gfile.GFile(os.path.join(field_path, fname), 'wb') as f:
-        pickle.dump(data, f)
-
-    dump(color, 'color')
-    dump(depth, 'depth')
-    dump(action, 'action')
-    dump(reward, 'reward')
-    dump(info, 'info')
-
-    self.n_episodes += 1
-    self.max_seed = max(self.max_seed, seed)
-
-  def set(self, episodes):
-    """Limit random samples to specific fixed set."""
+    with self.writer(seed) as writer:
+      for obs, act, reward, info in episode:
+        writer.append(obs, act, reward, info)
+      writer.commit()
+
+  def writer(self, seed):
+    """Returns an `EpisodeWriter` that streams a new episode to the dataset.
+
+    Args:
+      seed: random seed used to initialize the episode.
+    """
+    return EpisodeWriter(self, seed)
+
+  def _create_format(self, step, image_fields):
+    """Create the format file of a new dataset from a first episode step."""
+    episode_format = {}
+    for field in image_fields + DATA_FIELDS:
+      default = 'array' if field in image_fields else 'record'
+      spec = self._codec_specs.get(field, DEFAULT_CODECS[default])
+      codec = codecs.get(spec)
+      episode_format[field] = {'layout': codec.layout, 'codec': spec}
+      if codec.layout == 'array':
+        if field not in image_fields:
+          raise ValueError(f'{field} can not use array codec {spec}.')
+        stored = codec.encode_array(step[field])
+        episode_format[field].update(shape=list(stored.shape),
+                                     dtype=stored.dtype.name)
+    with self._locked():
+      # Another writer may have created the format in the meantime.
+      format_path = os.path.join(self.path, FORMAT_FNAME)
+      if os.path.exists(format_path):
+        with open(format_path, 'r') as f:
+          episode_format = json.load(f)
+      else:
+        write_atomic(format_path,
+                     json.dumps(episode_format, indent=2).encode())
+    self._set_format(episode_format)
+
+  def _set_format(self, episode_format):
+    """Set the format, where {} means records of RGB-D views only."""
+    self._format = episode_format
+    self.image_fields = tuple(f for f in IMAGE_FIELDS if f in episode_format)
+    if not self.image_fields:
+      self.image_fields = ('color', 'depth')
+    self._codecs = {}
+    for field in self._fields():
+      spec = self._format.get(field, {}).get(
+          'codec', DEFAULT_CODECS[self._layout(field)])
+      self._codecs[field] = codecs.get(spec)
+
+  def _layout(self, field):
+    return self._format.get(field, {}).get('layout', 'record')
+
+  def _decode_array(self, field, x):
+    """Decode stored array data; fields of other layouts are decoded on read."""
+    if self._layout(field) != 'array':
+      return x
+    return self._codecs[field].decode_array(x)
+
+  def _fields(self):
+    return self.image_fields + DATA_FIELDS
+
+  def _record_fields(self):
+    return [f for f in self._fields() if self._layout(f) == 'record']
+
+  def set(self, episodes, pin=False):
+    """Limit random samples to specific fixed set.
+
+    Args:
+      episodes: list of episode IDs.
+      pin: if True, cached fields of these episodes are never evicted.
+    """
     self.sample_set = episodes
+    if pin:
+      self._cache.pin(episodes)
+
+  def cache_info(self):
+    """Returns hit, miss and eviction counts and the size of the cache."""
+    return self._cache.info()
 
-  def load(self, episode_id, images=True, cache=False):
+  def load(self, episode_id, images=True, cache=None):
     """Load data from a saved episode.
 
     Args:
       episode_id: the ID of the episode to be loaded.
       images: load image data if True.
-      cache: load data from memory if True.
+      cache: load data from memory if True. Defaults to True if the dataset
+        has a cache budget.
 
     Returns:
       episode: list of (obs, act, reward, info) tuples.
       seed: random seed used to initialize the episode.
     """
+    if cache is None:
+      cache = self._cache_by_default
+    seed = self.episode_seed(episode_id)
+    fields = self._fields() if images else DATA_FIELDS
+    data = {field: self._decode_array(
+        field, self._load_field(episode_id, field, cache)) for field in fields}
+
+    # Reconstruct episode.
+    episode = []
+    for i in range(len(data['action'])):
+      obs = {field: data[field][i] for field in fields
+             if field in self.image_fields}
+      episode.append((obs, data['action'][i], data['reward'][i],
+                      data['info'][i]))
+    return episode, seed
+
+  def load_step(self, episode_id, step, images=True, cache=None):
+    """Load a single step of a saved episode.
+
+    Only the requested step is read from record files. Steps of older .pkl
+    episodes are taken from the fully loaded fields.
+
+    Args:
+      episode_id: the ID of the episode.
+      step: index of the step in the episode; negative values count from
+        the end.
+      images: load image data if True.
+      cache: load data from memory if True. Defaults to True if the dataset
+        has a cache budget.
+
+    Returns:
+      (obs, act, reward, info) tuple.
+    """
+    if cache is None:
+      cache = self._cache_by_default
+    fields = self._fields() if images else DATA_FIELDS
+    step = step % self.episode_length(episode_id)
+    data = {field: self._decode_array(
+        field, self._load_field_step(episode_id, field, step, cache))
+            for field in fields}
+    obs = {field: data[field] for field in fields
+           if field in self.image_fields}
+    return obs, data['action'], data['reward'], data['info']
+
+  def episode_length(self, episode_id):
+    """Number of steps of a saved episode, including the final one."""
+    return int(self._index['length'][episode_id])
+
+  def episode_seed(self, episode_id):
+    """Random seed used to initialize a saved episode."""
+    return int(self._index['seed'][episode_id])
+
+  def _is_pickled(self, episode_id):
+    """True for older episodes stored as one pickled list per field."""
+    return self._index['offsets'][episode_id] < 0
+
+  def _field_path(self, episode_id, field):
+    fname = f'{episode_id:06d}-{self.episode_seed(episode_id)}'
+    if self._is_pickled(episode_id):
+      ext = '.pkl'
+    elif self._layout(field) == 'array':
+      ext = '.npy'
+    else:
+      ext = '.rec'
+    return os.path.join(self.path, field, fname + ext)
+
+  def _record_offsets(self, episode_id, field):
+    """Offsets of the items of a record file, from the episode index."""
+    n_offsets = self.episode_length(episode_id) + 1
+    start = (self._index['offsets'][episode_id] +
+             self._record_fields().index(field) * n_offsets)
+    return self._index_offsets[start:start + n_offsets]
+
+  def _load_field(self, episode_id, field, cache):
+    """Load all steps of one field of an episode.
+
+    Array fields are returned as read-only memory maps of their stored
+    (encoded) data, so indexing them reads only the pages of the requested
+    steps. See `_decode_array`.
+    """
+
+    # Check if sample is in cache.
+    if cache:
+      data = self._cache.get((episode_id, field))
+      if data is not None:
+        return data
 
-    def load_field(episode_id, field, fname):
-
-      # Check if sample is in cache.
-      if cache:
-        if episode_id in self._cache:
-          if field in self._cache[episode_id]:
-            return self._cache[episode_id][field]
-        else:
-          self._cache[episode_id] = {}
-
-      # Load sample from files.
-      path = os.path.join(self.path, field)
-      data = pickle.load(open(os.path.join(path, fname), 'rb'))
-      if cache:
-        self._cache[episode_id][field] = data
-      return data
-
-    # Get filename and random seed used to initialize episode.
-    seed = None
-    path = os.path.join(self.path, 'action')
-    for fname in sorted(tf.io.gfile.listdir(path)):
-      if f'{episode_id:06d}' in fname:
-        seed = int(fname[(fname.find('-') + 1):-4])
-
-        # Load data.
-        color = load_field(episode_id, 'color', fname)
-        depth = load_field(episode_id, 'depth', fname)
-        action = load_field(episode_id, 'action', fname)
-        reward = load_field(episode_id, 'reward', fname)
-        info = load_field(episode_id, 'info', fname)
-
-        # Reconstruct episode.
-        episode = []
-        for i in range(len(action)):
-          obs = {'color': color[i], 'depth': depth[i]} if images else {}
-          episode.append((obs, action[i], reward[i], info[i]))
-        return episode, seed
-
-  def sample(self, images=True, cache=False):
+    # Load sample from files.
+    path = self._field_path(episode_id, field)
+    if self._is_pickled(episode_id):
+      with open(path, 'rb') as f:
+        data = pickle.load(f)
+    elif self._layout(field) == 'array':
+      data = np.load(path, mmap_mode='r')
+    else:
+      offsets = self._record_offsets(episode_id, field)
+      with open(path, 'rb') as f:
+        data = [read_record_item(f, offsets, i, self._codecs[field])
+                for i in range(len(offsets) - 1)]
+    if cache:
+      self._cache.put((episode_id, field), data)
+    return data
+
+  def _load_field_step(self, episode_id, field, step, cache):
+    """Load one step of one field of an episode."""
+    if (cache or self._is_pickled(episode_id) or
+        self._layout(field) == 'array'):
+      return self._load_field(episode_id, field, cache)[step]
+    offsets = self._record_offsets(episode_id, field)
+    with open(self._field_path(episode_id, field), 'rb') as f:
+      return read_record_item(f, offsets, step, self._codecs[field])
+
+  def sample(self, images=True, cache=None, rng=None):
     """Uniformly sample from the dataset.
 
+    Only the sampled step and the goal step are loaded from disk.
+
     Args:
       images: load image data if True.
-      cache: load data from memory if True.
+      cache: load data from memory if True. Defaults to True if the dataset
+        has a cache budget.
+      rng: optional np.random.RandomState. Defaults to the global generator.
 
     Returns:
       sample: randomly sampled (obs, act, reward, info) tuple.
       goal: the last (obs, act, reward, info) tuple in the episode.
     """
+    rng = np.random if rng is None else rng
 
     # Choose random episode.
     if len(self.sample_set) > 0:  # pylint: disable=g-explicit-length-test
-      episode_id = np.random.choice(self.sample_set)
+      episode_id = rng.choice(self.sample_set)
     else:
-      episode_id = np.random.choice(range(self.n_episodes))
-    episode, _ = self.load(episode_id, images, cache)
+      episode_id = rng.choice(range(self.n_episodes))
 
     # Return random observation action pair (and goal) from episode.
-    i = np.random.choice(range(len(episode) - 1))
-    sample, goal = episode[i], episode[-1]
+    length = self.episode_length(episode_id)
+    i = rng.choice(range(length - 1))
+    sample = self.load_step(episode_id, i, images, cache)
+    goal = self.load_step(episode_id, length - 1, images, cache)
     return sample, goal
+
+
+class EpisodeWriter:
+  """Streams an episode to a dataset one step at a time.
+
+  Every appended step is encoded and written to temporary files right away,
+  so only the current step is held in memory. `commit` moves the files into
+  place and indexes the episode; `abort`, or leaving a `with` block without
+  committing, deletes them:
+
+    with dataset.writer(seed) as writer:
+      for obs, act, reward, info in steps:
+        writer.append(obs, act, reward, info)
+      if total_reward > 0.99:
+        writer.commit()
+  """
+
+  # The writer extends the Dataset it writes to.
+  # pylint: disable=protected-access
+
+  def __init__(self, dataset, seed):
+    self.dataset = dataset
+    self.seed = seed
+    self.length = 0
+    self._tmp_fname = writer_tmp_fname()
+    self._writers = None  # Field writers, opened with the first step.
+    self._done = False
+
+  def append(self, obs, act, reward, info):
+    """Write one (obs, act, reward, info) step of the episode."""
+    if self._done:
+      raise ValueError('Episode was already committed or aborted.')
+    ds = self.dataset
+    image_fields = tuple(f for f in IMAGE_FIELDS if f in obs)
+    step = {field: np.asarray(obs[field], dtype=ARRAY_FIELDS[field])
+            for field in image_fields}
+    step.update(action=act, reward=reward, info=info)
+    if ds._format is None:
+      ds._create_format(step, image_fields)
+    if image_fields != ds.image_fields:
+      raise ValueError(f'Expected observations with {ds.image_fields}, got '
+                       f'{image_fields}.')
+    if self._writers is None:
+      self._writers = {field: self._open(field) for field in ds._fields()}
+    for field, writer in self._writers.items():
+      if isinstance(writer, ArrayWriter):
+        x = ds._codecs[field].encode_array(step[field])
+        if x.shape != writer.step_shape:
+          raise ValueError(f'Expected {field} of shape {writer.step_shape}, '
+                           f'got {x.shape}.')
+        writer.write(x)
+      else:
+        writer.write(step[field])
+    self.length += 1
+
+  def _open(self, field):
+    """Open the temporary file writer of a field."""
+    ds = self.dataset
+    field_path = os.path.join(ds.path, field)
+    if not tf.io.gfile.exists(field_path):
+      tf.io.gfile.makedirs(field_path)
+    path = os.path.join(field_path, self._tmp_fname)
+    if ds._layout(field) == 'array':
+      field_format = ds._format[field]
+      return ArrayWriter(path, field_format['dtype'], field_format['shape'])
+    return RecordWriter(path, ds._codecs[field])
+
+  def commit(self):
+    """Move the episode files into place and add the episode to the index.
+
+    Returns:
+      ID of the new episode.
+    """
+    if self._done or not self.length:
+      raise ValueError('Can only commit a new episode with at least one step.')
+    ds = self.dataset
+    offsets, exts = [], {}
+    for field, writer in self._writers.items():
+      if isinstance(writer, ArrayWriter):
+        writer.close()
+        exts[field] = '.npy'
+      else:
+        offsets.append(writer.close())
+        exts[field] = '.rec'
+    self._done = True
+
+    # Take the next episode ID, merging in episodes of other writers, and
+    # index the episode only once all its files are in place.
+    with ds._locked():
+      ds._read_index()
+      episode_id = ds.n_episodes
+      fname = f'{episode_id:06d}-{self.seed}'
+      for field, writer in self._writers.items():
+        os.replace(writer.path,
+                   os.path.join(ds.path, field, fname + exts[field]))
+      row = (episode_id, self.seed, self.length, len(ds._index_offsets))
+      ds._append_index([row], np.concatenate(offsets))
+    return episode_id
+
+  def abort(self):
+    """Delete the written steps; does nothing after `commit`."""
+    if not self._done and self._writers is not None:
+      for writer in self._writers.values():
+        writer.abort()
+    self._done = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.abort()
+
+
+#-----------------------------------------------------------------------------
+# PREFETCHING
+#-----------------------------------------------------------------------------
+
+# Sample function of a Prefetcher worker process.
+_worker_sample_fn = None
+
+
+def _init_prefetch_worker(sample_fn):
+  global _worker_sample_fn
+  _worker_sample_fn = sample_fn
+
+
+def _prefetch_sample(seed, i, sample_fn=None):
+  """Computes sample i of a sequence; worker processes use their own fn."""
+  sample_fn = _worker_sample_fn if sample_fn is None else sample_fn
+  state = np.random.SeedSequence([seed, i]).generate_state(4)
+  return sample_fn(rng=np.random.RandomState(state))
+
+
+class Prefetcher:
+  """Produces samples ahead of time in background threads or processes.
+
+  Sample i is `sample_fn(rng=rng)`, where rng is a np.random.RandomState
+  seeded from (seed, i). Samples are returned in order, so the sequence only depends
+  on `seed`, not on the number or kind of workers.
+
+  Typical use in a training loop:
+
+    prefetcher = Prefetcher(functools.partial(agent.get_sample, dataset), seed)
+    for _ in range(n_steps):
+      agent.train(dataset, writer, sample=next(prefetcher))
+    prefetcher.close()
+  """
+
+  def __init__(self,
+               sample_fn,
+               seed,
+               n_workers=2,
+               queue_depth=8,
+               processes=False,
+               start_method='spawn'):
+    """Starts the workers and queues the first samples.
+
+    Args:
+      sample_fn: callable taking a np.random.RandomState as keyword argument
+        `rng` and returning a sample. It must be picklable with
+        `start_method` if `processes`.
+      seed: integer seed of the sample sequence.
+      n_workers: number of worker threads or processes.
+      queue_depth: number of samples computed ahead of the consumer.
+      processes: use worker processes instead of threads. Threads suffice
+        when `sample_fn` mostly waits on I/O or releases the GIL (NumPy,
+        OpenCV); processes parallelize pure-Python work.
+      start_method: multiprocessing start method for worker processes.
+    """
+    self._seed = seed
+    self._next = 0
+    if processes:
+      # Send sample_fn to each worker once rather than with every sample.
+      self._sample_fn = None
+      self._executor = futures.ProcessPoolExecutor(
+          n_workers, mp_context=multiprocessing.get_context(start_method),
+          initializer=_init_prefetch_worker, initargs=(sample_fn,))
+    else:
+      self._sample_fn = sample_fn
+      self._executor = futures.ThreadPoolExecutor(n_workers)
+    self._queue = collections.deque()
+    for _ in range(queue_depth):
+      self._submit()
+
+  def _submit(self):
+    self._queue.append(self._executor.submit(
+        _prefetch_sample, self._seed, self._next, self._sample_fn))
+    self._next += 1
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    sample = self._queue.popleft().result()
+    self._submit()
+    return sample
+
+  def close(self):
+    for future in self._queue:
+      future.cancel()
+    self._executor.shutdown(wait=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -11,6 +11,7 @@ from src import tasks
 from src.dataset import Dataset
 from src.environments.environment import ContinuousEnvironment
 from src.environments.environment import Environment
+from src.utils import codecs
 
 flags.DEFINE_string('assets_root', '.', '')
 flags.DEFINE_string('data_dir', './dataset', '')
@@ -21,6 +22,13 @@ flags.DEFINE_string('mode', 'train', '')
 flags.DEFINE_integer('n', 1000, '')
 flags.DEFINE_bool('continuous', False, '')
 flags.DEFINE_integer('steps_per_seg', 3, '')
+flags.DEFINE_bool('fast_reset', False, 'Restore a scene snapshot on reset.')
+flags.DEFINE_bool('lazy_obs', False, 'Skip rendering unread observations.')
+flags.DEFINE_bool('orthographic_oracle', False, 'Render oracle heightmaps '
+                  'with an orthographic camera. Faster, but seeds produce '
+                  'other scenes than in datasets collected without it.')
+flags.DEFINE_list('codecs', [], 'Field codecs of a new dataset, e.g. '
+                  'depth:uint16_mm,color:png,info:zlib.')
 
 FLAGS = flags.FLAGS
 
@@ -33,19 +41,22 @@ def main(unused_argv):
         FLAGS.assets_root,
         disp=FLAGS.disp,
         shared_memory=FLAGS.shared_memory,
-        hz=480)
+        hz=480,
+        fast_reset=FLAGS.fast_reset,
+        lazy_obs=FLAGS.lazy_obs)
     task = tasks.names[FLAGS.task](continuous=FLAGS.continuous)
     task.mode = FLAGS.mode
+    task.orthographic_oracle = FLAGS.orthographic_oracle
 
     # Initialize scripted oracle agent and dataset.
     agent = task.oracle(env, steps_per_seg=FLAGS.steps_per_seg)
-    dataset = Dataset(os.path.join(
-        FLAGS.data_dir, f'{FLAGS.task}-{task.mode}'))
+    dataset = Dataset(
+        os.path.join(FLAGS.data_dir, f'{FLAGS.task}-{task.mode}'),
+        codecs=codecs.parse_field_specs(FLAGS.codecs))
 
-    # Train seeds are even and test seeds are odd.
-    seed = dataset.max_seed
-    if seed < 0:
-        seed = -1 if (task.mode == 'test') else -2
+    # Train seeds are even and test seeds are odd. They are reserved through
+    # the dataset, so several demo.py processes can fill it in parallel.
+    first_seed = 1 if (task.mode == 'test') else 0
 
     # Determine max steps per episode.
     max_steps = task.max_steps
@@ -55,29 +66,31 @@ def main(unused_argv):
     # Collect training data from oracle demonstrations.
     while dataset.n_episodes < FLAGS.n:
         print(f'Oracle demonstration: {dataset.n_episodes + 1}/{FLAGS.n}')
-        episode, total_reward = [], 0
-        seed += 2
+        total_reward = 0
+        seed = dataset.reserve_seed(first_seed)
         np.random.seed(seed)
         env.set_task(task)
         obs = env.reset()
         info = None
         reward = 0
-        for _ in range(max_steps):
-            act = agent.act(obs, info)
-            episode.append((obs, act, reward, info))
-            obs, reward, done, info = env.step(act)
-            print(obs,reward,done,info)
-            total_reward += reward
-
-            print(f'Total Reward: {total_reward} Done: {done}')
-            if done:
-                break
-        episode.append((obs, None, reward, info))
-
-        # Only save completed demonstrations.
+
+        # Stream steps to disk and only save completed demonstrations.
         # TODO(andyzeng): add back deformable logic.
-        if total_reward > 0.99:
-            dataset.add(seed, episode)
+        with dataset.writer(seed) as writer:
+            for _ in range(max_steps):
+                act = agent.act(obs, info)
+                writer.append(obs, act, reward, info)
+                obs, reward, done, info = env.step(act)
+                print(obs,reward,done,info)
+                total_reward += reward
+
+                print(f'Total Reward: {total_reward} Done: {done}')
+                if done:
+                    break
+            # The last observation of a failed demonstration is never saved.
+            if total_reward > 0.99:
+                writer.append(obs, None, reward, info)
+                writer.commit()
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 """Environment class."""
 
+import collections.abc
 import os
 import pkgutil
 import sys
@@ -14,6 +15,7 @@ from src.utils import pybullet_utils
 from src.utils import utils
 
 import pybullet as p
+from pybullet_utils import bullet_client
 
 
 PLACE_STEP = 0.0003
@@ -24,6 +26,50 @@ UR5_WORKSPACE_URDF_PATH = 'ur5/workspace.urdf'
 PLANE_URDF_PATH = 'plane/plane.urdf'
 
 
+class LazyObservation(collections.abc.Mapping):
+  """Observation mapping that renders cameras only when first accessed.
+
+  The rendered observation is cached, so every key of one step shares a
+  single render. Pickling produces a plain dict. An observation discarded
+  before it was read is never rendered and can no longer be read.
+  """
+
+  def __init__(self, render_fn, keys):
+    self._render_fn = render_fn
+    self._keys = tuple(keys)
+    self._obs = None
+
+  @property
+  def rendered(self):
+    return self._obs is not None
+
+  def discard(self):
+    """Drops the observation without rendering it, unless already rendered."""
+    self._render_fn = None
+
+  def render(self):
+    """Renders the observation if needed and returns it as a dict."""
+    if self._obs is None:
+      if self._render_fn is None:
+        raise ValueError('Lazy observation was not read before the next '
+                         '`step` or `reset` of its environment.')
+      self._obs = self._render_fn()
+      self._render_fn = None
+    return self._obs
+
+  def __getitem__(self, key):
+    return self.render()[key]
+
+  def __iter__(self):
+    return iter(self._keys)
+
+  def __len__(self):
+    return len(self._keys)
+
+  def __reduce__(self):
+    return (dict, (self.render(),))
+
+
 class Environment(gym.Env):
   """OpenAI Gym-style environment class."""
 
@@ -33,7 +79,10 @@ class Environment(gym.Env):
                disp=False,
                shared_memory=False,
                hz=240,
-               use_egl=False):
+               use_egl=False,
+               fast_reset=False,
+               render_profile=None,
+               lazy_obs=False):
     """Creates OpenAI Gym-style environment with PyBullet.
 
     Args:
@@ -45,6 +94,17 @@ class Environment(gym.Env):
       hz: PyBullet physics simulation step speed. Set to 480 for deformables.
       use_egl: Whether to use EGL rendering. Only supported on Linux. Should get
         a significant speedup in rendering when using.
+      fast_reset: if True, the static scene (plane, workspace, robot and end
+        effector) is loaded once and snapshotted, and later resets restore the
+        snapshot and only remove the previous task objects.
+      render_profile: optional name of a render profile in `cameras.PROFILES`
+        for the agent cameras. Defaults to the profile of their configs.
+        Agents reconstructing heightmaps must use the same `agent_cams`.
+      lazy_obs: if True, `reset` and `step` return a `LazyObservation` that
+        renders the agent cameras only when it is first read. Observations
+        must be read before the next `step` or `reset`: unread ones are
+        dropped without rendering and raise ValueError if read later, so
+        they never show a later state than the one they were returned for.
 
     Raises:
       RuntimeError: if pybullet cannot load fileIOPlugin.
@@ -56,8 +116,16 @@ class Environment(gym.Env):
     self.obj_ids = {'fixed': [], 'rigid': [], 'deformable': []}
     self.homej = np.array([-1, -0.5, 0.5, -0.5, -0.5, 0]) * np.pi
     self.agent_cams = cameras.RealSenseD415.CONFIG
+    if render_profile is not None:
+      self.agent_cams = [cameras.apply_profile(config, render_profile)
+                         for config in self.agent_cams]
 
     self.assets_root = assets_root
+    self.fast_reset = fast_reset
+    self.lazy_obs = lazy_obs
+    self._pending_obs = None
+    self._scene_state = None
+    self._scene_ee = None
 
     color_tuple = [
         gym.spaces.Box(0, 255, config['image_size'] + (3,), dtype=np.uint8)
@@ -87,22 +155,20 @@ class Environment(gym.Env):
                  gym.spaces.Box(-1.0, 1.0, shape=(4,), dtype=np.float32)))
     })
 
-    # Start PyBullet.
+    # Start PyBullet. Each environment owns its own physics client, so several
+    # environments can run side by side in the same process.
     disp_option = p.DIRECT
     if disp:
       disp_option = p.GUI
       if shared_memory:
         disp_option = p.SHARED_MEMORY
-    client = p.connect(disp_option)
-    file_io = p.loadPlugin('fileIOPlugin', physicsClientId=client)
+    self.pybullet_client = bullet_client.BulletClient(disp_option)
+    file_io = self.pybullet_client.loadPlugin('fileIOPlugin')
     if file_io < 0:
       raise RuntimeError('pybullet: cannot load FileIO!')
     if file_io >= 0:
-      p.executePluginCommand(
-          file_io,
-          textArgument=assets_root,
-          intArgs=[p.AddFileIOAction],
-          physicsClientId=client)
+      self.pybullet_client.executePluginCommand(
+          file_io, textArgument=assets_root, intArgs=[p.AddFileIOAction])
 
     self._egl_plugin = None
     if use_egl:
@@ -110,22 +176,26 @@ class Environment(gym.Env):
                                        'Linux.')
       egl = pkgutil.get_loader('eglRenderer')
       if egl:
-        self._egl_plugin = p.loadPlugin(egl.get_filename(),
-                                        '_eglRendererPlugin')
+        self._egl_plugin = self.pybullet_client.loadPlugin(
+            egl.get_filename(), '_eglRendererPlugin')
       else:
-        self._egl_plugin = p.loadPlugin('eglRendererPlugin')
+        self._egl_plugin = self.pybullet_client.loadPlugin('eglRendererPlugin')
       print('EGL renderering enabled.')
 
-    p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0)
-    p.setPhysicsEngineParameter(enableFileCaching=0)
-    p.setAdditionalSearchPath(assets_root)
-    p.setAdditionalSearchPath(tempfile.gettempdir())
-    p.setTimeStep(1. / hz)
+    # Without GUI or EGL, pybullet renders with TinyRenderer, whose zbuffer
+    # differs from OpenGL's for non-perspective projections.
+    self._opengl = disp or self._egl_plugin is not None
+
+    self.pybullet_client.configureDebugVisualizer(p.COV_ENABLE_GUI, 0)
+    self.pybullet_client.setPhysicsEngineParameter(enableFileCaching=0)
+    self.pybullet_client.setAdditionalSearchPath(assets_root)
+    self.pybullet_client.setAdditionalSearchPath(tempfile.gettempdir())
+    self.pybullet_client.setTimeStep(1. / hz)
 
     # If using --disp, move default camera closer to the scene.
     if disp:
-      target = p.getDebugVisualizerCamera()[11]
-      p.resetDebugVisualizerCamera(
+      target = self.pybullet_client.getDebugVisualizerCamera()[11]
+      self.pybullet_client.resetDebugVisualizerCamera(
           cameraDistance=1.1,
           cameraYaw=90,
           cameraPitch=-25,
@@ -137,7 +207,7 @@ class Environment(gym.Env):
   @property
   def is_static(self):
     """Return true if objects are no longer moving."""
-    v = [np.linalg.norm(p.getBaseVelocity(i)[0])
+    v = [np.linalg.norm(self.pybullet_client.getBaseVelocity(i)[0])
          for i in self.obj_ids['rigid']]
     return all(np.array(v) < 5e-3)
 
@@ -145,7 +215,7 @@ class Environment(gym.Env):
     """List of (fixed, rigid, or deformable) objects in env."""
     fixed_base = 1 if category == 'fixed' else 0
     obj_id = pybullet_utils.load_urdf(
-        p,
+        self.pybullet_client,
         os.path.join(self.assets_root, urdf),
         pose[0],
         pose[1],
@@ -166,45 +236,82 @@ class Environment(gym.Env):
     if not self.task:
       raise ValueError('environment task must be set. Call set_task or pass '
                        'the task arg in the environment constructor.')
-    self.obj_ids = {'fixed': [], 'rigid': [], 'deformable': []}
-    p.resetSimulation(p.RESET_USE_DEFORMABLE_WORLD)
-    p.setGravity(0, 0, -9.8)
+    self.skip_obs()
 
     # Temporarily disable rendering to load scene faster.
-    p.configureDebugVisualizer(p.COV_ENABLE_RENDERING, 0)
+    self.pybullet_client.configureDebugVisualizer(p.COV_ENABLE_RENDERING, 0)
 
-    pybullet_utils.load_urdf(p, os.path.join(self.assets_root, PLANE_URDF_PATH),
-                             [0, 0, -0.001])
+    if (self.fast_reset and self._scene_state is not None and
+        self._scene_ee == self.task.ee):
+      self._restore_scene()
+    else:
+      self._load_scene()
+
+    # Reset task.
+    self.task.reset(self)
+
+    # Re-enable rendering.
+    self.pybullet_client.configureDebugVisualizer(p.COV_ENABLE_RENDERING, 1)
+
+    obs, _, _, _ = self.step()
+    return obs
+
+  def _load_scene(self):
+    """Rebuilds the simulation with the robot at its home configuration."""
+    self.obj_ids = {'fixed': [], 'rigid': [], 'deformable': []}
+    self.pybullet_client.resetSimulation(p.RESET_USE_DEFORMABLE_WORLD)
+    self.pybullet_client.setGravity(0, 0, -9.8)
+
+    pybullet_utils.load_urdf(
+        self.pybullet_client,
+        os.path.join(self.assets_root, PLANE_URDF_PATH), [0, 0, -0.001])
     pybullet_utils.load_urdf(
-        p, os.path.join(self.assets_root, UR5_WORKSPACE_URDF_PATH), [0.5, 0, 0])
+        self.pybullet_client,
+        os.path.join(self.assets_root, UR5_WORKSPACE_URDF_PATH), [0.5, 0, 0])
 
     # Load UR5 robot arm equipped with suction end effector.
     # TODO(andyzeng): add back parallel-jaw grippers.
     self.ur5 = pybullet_utils.load_urdf(
-        p, os.path.join(self.assets_root, UR5_URDF_PATH))
-    self.ee = self.task.ee(self.assets_root, self.ur5, 9, self.obj_ids)
+        self.pybullet_client, os.path.join(self.assets_root, UR5_URDF_PATH))
+    self.ee = self.task.ee(self.assets_root, self.ur5, 9, self.obj_ids,
+                           self.pybullet_client)
     self.ee_tip = 10  # Link ID of suction cup.
 
     # Get revolute joint indices of robot (skip fixed joints).
-    n_joints = p.getNumJoints(self.ur5)
-    joints = [p.getJointInfo(self.ur5, i) for i in range(n_joints)]
+    n_joints = self.pybullet_client.getNumJoints(self.ur5)
+    joints = [self.pybullet_client.getJointInfo(self.ur5, i)
+              for i in range(n_joints)]
     self.joints = [j[0] for j in joints if j[2] == p.JOINT_REVOLUTE]
 
     # Move robot to home joint configuration.
     for i in range(len(self.joints)):
-      p.resetJointState(self.ur5, self.joints[i], self.homej[i])
+      self.pybullet_client.resetJointState(self.ur5, self.joints[i],
+                                           self.homej[i])
 
     # Reset end effector.
     self.ee.release()
 
-    # Reset task.
-    self.task.reset(self)
-
-    # Re-enable rendering.
-    p.configureDebugVisualizer(p.COV_ENABLE_RENDERING, 1)
+    # Snapshot the static scene so that later resets can restore it.
+    if self.fast_reset:
+      self._scene_state = self.pybullet_client.saveState()
+      self._scene_ee = self.task.ee
 
-    obs, _, _, _ = self.step()
-    return obs
+  def _restore_scene(self):
+    """Removes task objects and restores the static scene snapshot."""
+    self.ee.release()
+    for obj_ids in self.obj_ids.values():
+      for obj_id in obj_ids:
+        self.pybullet_client.removeBody(obj_id)
+      obj_ids.clear()  # The end effector shares this dict; clear in place.
+    self.pybullet_client.restoreState(self._scene_state)
+
+    # Motor targets are not part of the snapshot; hold the home configuration.
+    self.pybullet_client.setJointMotorControlArray(
+        bodyIndex=self.ur5,
+        jointIndices=self.joints,
+        controlMode=p.POSITION_CONTROL,
+        targetPositions=self.homej,
+        positionGains=np.ones(len(self.joints)))
 
   def step(self, action=None):
     """Execute action with specified primitive.
@@ -215,18 +322,19 @@ class Environment(gym.Env):
     Returns:
       (obs, reward, done, info) tuple containing MDP step data.
     """
+    self.skip_obs()
     if action is not None:
       timeout = self.task.primitive(self.movej, self.movep, self.ee, **action)
 
       # Exit early if action times out. We still return an observation
       # so that we don't break the Gym API contract.
       if timeout:
-        obs = self._get_obs()
+        obs = self._observe()
         return obs, 0.0, True, self.info
 
     # Step simulator asynchronously until objects settle.
     while not self.is_static:
-      p.stepSimulation()
+      self.pybullet_client.stepSimulation()
 
     # Get task rewards.
     reward, info = self.task.reward() if action is not None else (0, {})
@@ -235,14 +343,15 @@ class Environment(gym.Env):
     # Add ground truth robot state into info.
     info.update(self.info)
 
-    obs = self._get_obs()
+    obs = self._observe()
 
     return obs, reward, done, info
 
   def close(self):
+    self.skip_obs()
     if self._egl_plugin is not None:
-      p.unloadPlugin(self._egl_plugin)
-    p.disconnect()
+      self.pybullet_client.unloadPlugin(self._egl_plugin)
+    self.pybullet_client.disconnect()
 
   def render(self, mode='rgb_array'):
     # Render only the color image from the first camera.
@@ -253,37 +362,30 @@ class Environment(gym.Env):
     return color
 
   def render_camera(self, config):
-    """Render RGB-D image with specified camera configuration."""
-
-    # OpenGL camera settings.
-    lookdir = np.float32([0, 0, 1]).reshape(3, 1)
-    updir = np.float32([0, -1, 0]).reshape(3, 1)
-    rotation = p.getMatrixFromQuaternion(config['rotation'])
-    rotm = np.float32(rotation).reshape(3, 3)
-    lookdir = (rotm @ lookdir).reshape(-1)
-    updir = (rotm @ updir).reshape(-1)
-    lookat = config['position'] + lookdir
-    focal_len = config['intrinsics'][0]
-    znear, zfar = config['zrange']
-    viewm = p.computeViewMatrix(config['position'], lookat, updir)
-    fovh = (config['image_size'][0] / 2) / focal_len
-    fovh = 180 * np.arctan(fovh) * 2 / np.pi
-
-    # Notes: 1) FOV is vertical FOV 2) aspect must be float
-    aspect_ratio = config['image_size'][1] / config['image_size'][0]
-    projm = p.computeProjectionMatrixFOV(fovh, aspect_ratio, znear, zfar)
+    """Render RGB-D image with specified camera configuration.
+
+    Args:
+      config: camera config dict. Its 'profile' selects shadows, segmentation
+        output and renderer (see `cameras.PROFILES`).
+
+    Returns:
+      (color, depth, segm) tuple. segm is None if the profile disables
+        segmentation.
+    """
+
+    camera = cameras.Camera.from_config(config)
 
     # Render with OpenGL camera settings.
-    _, _, color, depth, segm = p.getCameraImage(
-        width=config['image_size'][1],
-        height=config['image_size'][0],
-        viewMatrix=viewm,
-        projectionMatrix=projm,
-        shadow=1,
-        flags=p.ER_SEGMENTATION_MASK_OBJECT_AND_LINKINDEX,
+    _, _, color, depth, segm = self.pybullet_client.getCameraImage(
+        width=camera.width,
+        height=camera.height,
+        viewMatrix=camera.view_matrix,
+        projectionMatrix=camera.projection_matrix,
+        shadow=camera.shadow,
+        flags=camera.flags,
         # Note when use_egl is toggled, this option will not actually use openGL
         # but EGL instead.
-        renderer=p.ER_BULLET_HARDWARE_OPENGL)
+        renderer=camera.renderer)
 
     # Get color image.
     color_image_size = (config['image_size'][0], config['image_size'][1], 4)
@@ -296,17 +398,56 @@ class Environment(gym.Env):
 
     # Get depth image.
     depth_image_size = (config['image_size'][0], config['image_size'][1])
-    zbuffer = np.array(depth).reshape(depth_image_size)
-    depth = (zfar + znear - (2. * zbuffer - 1.) * (zfar - znear))
-    depth = (2. * znear * zfar) / depth
+    depth = camera.linearize_depth(depth)
     if config['noise']:
       depth += self._random.normal(0, 0.003, depth_image_size)
 
-    # Get segmentation image.
-    segm = np.uint8(segm).reshape(depth_image_size)
+    # Get segmentation image, if the camera's render profile asks for it.
+    if camera.segmentation:
+      segm = np.uint8(segm).reshape(depth_image_size)
+    else:
+      segm = None
 
     return color, depth, segm
 
+  def render_heightmap(self, config, bounds, pixel_size):
+    """Render a top-down heightmap with an orthographic camera.
+
+    Args:
+      config: top-down camera config dict providing the near clipping plane and
+        render profile (see `cameras.OrthographicCamera`).
+      bounds: 3x2 float array of workspace bounds (rows: X,Y,Z; columns:
+        min,max) in world coordinates.
+      pixel_size: float defining size of each pixel in meters.
+
+    Returns:
+      (cmap, hmap, mask) tuple of HxWx3 uint8 colormap, HxW float32 heightmap
+        (from lower z-bound) and HxW int32 object id mask. Pixels whose surface
+        lies outside the z-bounds are zero in all three.
+    """
+    camera = cameras.OrthographicCamera.from_config(config, bounds, pixel_size)
+    _, _, color, depth, segm = self.pybullet_client.getCameraImage(
+        width=camera.width,
+        height=camera.height,
+        viewMatrix=camera.view_matrix,
+        projectionMatrix=camera.projection_matrix,
+        shadow=camera.shadow,
+        flags=camera.flags,
+        renderer=camera.renderer)
+
+    zs = camera.heights(depth, opengl=self._opengl)
+    valid = (zs >= camera.zmin) & (zs < camera.zmax)
+    hmap = np.float32(np.where(valid, zs - camera.zmin, 0))
+    color = np.array(color, dtype=np.uint8).reshape(
+        camera.height, camera.width, 4)[::-1, :, :3]
+    cmap = np.where(valid[Ellipsis, None], color, 0).astype(np.uint8)
+    if camera.segmentation:
+      segm = np.int32(segm).reshape(camera.height, camera.width)[::-1]
+      mask = np.where(valid, segm & 0xFFFFFF, 0).astype(np.int32)
+    else:
+      mask = np.zeros_like(hmap, dtype=np.int32)
+    return cmap, hmap, mask
+
   @property
   def info(self):
     """Environment info variable with object poses, dimensions, and colors."""
@@ -320,13 +461,14 @@ class Environment(gym.Env):
     info = {}  # object id : (position, rotation, dimensions)
     for obj_ids in self.obj_ids.values():
       for obj_id in obj_ids:
-        pos, rot = p.getBasePositionAndOrientation(obj_id)
-        dim = p.getVisualShapeData(obj_id)[0][3]
+        pos, rot = self.pybullet_client.getBasePositionAndOrientation(obj_id)
+        dim = self.pybullet_client.getVisualShapeData(obj_id)[0][3]
         info[obj_id] = (pos, rot, dim)
     return info
 
   def set_task(self, task):
     task.set_assets_root(self.assets_root)
+    task.set_pybullet_client(self.pybullet_client)
     self.task = task
 
   #---------------------------------------------------------------------------
@@ -337,7 +479,8 @@ class Environment(gym.Env):
     """Move UR5 to target joint configuration."""
     t0 = time.time()
     while (time.time() - t0) < timeout:
-      currj = [p.getJointState(self.ur5, i)[0] for i in self.joints]
+      currj = [self.pybullet_client.getJointState(self.ur5, i)[0]
+               for i in self.joints]
       currj = np.array(currj)
       diffj = targj - currj
       if all(np.abs(diffj) < 1e-2):
@@ -348,13 +491,13 @@ class Environment(gym.Env):
       v = diffj / norm if norm > 0 else 0
       stepj = currj + v * speed
       gains = np.ones(len(self.joints))
-      p.setJointMotorControlArray(
+      self.pybullet_client.setJointMotorControlArray(
           bodyIndex=self.ur5,
           jointIndices=self.joints,
           controlMode=p.POSITION_CONTROL,
           targetPositions=stepj,
           positionGains=gains)
-      p.stepSimulation()
+      self.pybullet_client.stepSimulation()
     print(f'Warning: movej exceeded {timeout} second timeout. Skipping.')
     return True
 
@@ -365,7 +508,7 @@ class Environment(gym.Env):
 
   def solve_ik(self, pose):
     """Calculate joint configuration with inverse kinematics."""
-    joints = p.calculateInverseKinematics(
+    joints = self.pybullet_client.calculateInverseKinematics(
         bodyUniqueId=self.ur5,
         endEffectorLinkIndex=self.ee_tip,
         targetPosition=pose[0],
@@ -380,6 +523,25 @@ class Environment(gym.Env):
     joints[2:] = (joints[2:] + np.pi) % (2 * np.pi) - np.pi
     return joints
 
+  def skip_obs(self):
+    """Drops the last observation of `reset` or `step` unless it was read.
+
+    `step` and `reset` do this first. Call it to drop an observation earlier,
+    e.g. before pickling the environment's results. Reading a dropped
+    observation raises ValueError. Does nothing if observations are not lazy.
+    """
+    if self._pending_obs is not None:
+      self._pending_obs.discard()
+      self._pending_obs = None
+
+  def _observe(self):
+    """Returns the current observation, deferring rendering if lazy."""
+    if not self.lazy_obs:
+      return self._get_obs()
+    obs = LazyObservation(self._get_obs, self.observation_space.spaces)
+    self._pending_obs = obs
+    return obs
+
   def _get_obs(self):
     # Get RGB-D camera image observations.
     obs = {'color': (), 'depth': ()}
@@ -484,21 +646,22 @@ class ContinuousEnvironment(Environment):
       })
 
   def get_ee_pose(self):
-    return p.getLinkState(self.ur5, self.ee_tip)[0:2]
+    return self.pybullet_client.getLinkState(self.ur5, self.ee_tip)[0:2]
 
   def step(self, action=None):
+    self.skip_obs()
     if action is not None:
       timeout = self.task.primitive(self.movej, self.movep, self.ee, action)
 
       # Exit early if action times out. We still return an observation
       # so that we don't break the Gym API contract.
       if timeout:
-        obs = self._get_obs()
+        obs = self._observe()
         return obs, 0.0, True, self.info
 
     # Step simulator asynchronously until objects settle.
     while not self.is_static:
-      p.stepSimulation()
+      self.pybullet_client.stepSimulation()
 
     # Get task rewards.
     reward, info = self.task.reward() if action is not None else (0, {})
@@ -511,6 +674,6 @@ class ContinuousEnvironment(Environment):
     # Add ground truth robot state into info.
     info.update(self.info)
 
-    obs = self._get_obs()
+    obs = self._observe()
 
     return obs, reward, done, info
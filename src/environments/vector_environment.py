@@ -0,0 +1,307 @@
+"""Vectorized environment that steps several simulators in parallel."""
+
+import multiprocessing
+from multiprocessing import shared_memory
+import traceback
+
+import numpy as np
+
+
+class SharedObservationBuffer:
+  """Ring of shared-memory observation slots for a batch of environments.
+
+  Every (key, index) entry of a `gym.spaces.Dict` of `gym.spaces.Tuple`
+  observation space gets one shared-memory block of shape
+  (n_slots, num_envs) + space.shape. Workers copy their observation into
+  their row of the current slot and the parent reads it back as a NumPy view,
+  so images never go through pickling or pipes.
+  """
+
+  def __init__(self, specs, create=False):
+    """Creates or attaches to the shared-memory blocks.
+
+    Args:
+      specs: list of (key, index, name, shape, dtype) tuples. `name` is ignored
+        when `create` is True.
+      create: allocate new blocks if True, otherwise attach to existing ones.
+    """
+    self.specs = []
+    self.arrays = {}
+    self._shms = []
+    for key, i, name, shape, dtype in specs:
+      nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+      if create:
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+      else:
+        shm = shared_memory.SharedMemory(name=name)
+      self._shms.append(shm)
+      self.specs.append((key, i, shm.name, shape, dtype))
+      array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+      self.arrays.setdefault(key, []).append(array)
+
+  @classmethod
+  def from_space(cls, observation_space, num_envs, n_slots):
+    """Allocates buffers matching an observation space."""
+    specs = []
+    for key, space in observation_space.spaces.items():
+      for i, box in enumerate(space.spaces):
+        shape = (n_slots, num_envs) + tuple(box.shape)
+        specs.append((key, i, None, shape, box.dtype))
+    return cls(specs, create=True)
+
+  def write(self, obs, slot, env_index):
+    """Copies one environment's observation into its row of a slot."""
+    for key, arrays in self.arrays.items():
+      for array, x in zip(arrays, obs[key]):
+        array[slot, env_index] = x
+
+  def read(self, slot, indices=None):
+    """Returns a batched observation for a slot.
+
+    Args:
+      slot: slot to read.
+      indices: optional list of environment rows. Without it the result
+        consists of views into shared memory; with it rows are gathered into
+        new arrays.
+
+    Returns:
+      batched observation, see `stack_obs`.
+    """
+    if indices is None:
+      return {key: tuple(array[slot] for array in arrays)
+              for key, arrays in self.arrays.items()}
+    return {key: tuple(array[slot, list(indices)] for array in arrays)
+            for key, arrays in self.arrays.items()}
+
+  def close(self, unlink=False):
+    self.arrays = {}
+    for shm in self._shms:
+      shm.close()
+      if unlink:
+        shm.unlink()
+    self._shms = []
+
+
+def _worker(conn, env_fn, auto_reset):
+  """Runs one environment and serves commands sent over `conn`."""
+  env = env_fn()
+  obs_buffer, env_index = None, None
+
+  def send_obs(obs, slot):
+    if obs_buffer is None or obs is None:
+      return obs
+    obs_buffer.write(obs, slot, env_index)
+    return None
+
+  try:
+    while True:
+      cmd, data = conn.recv()
+      try:
+        if cmd == 'step':
+          action, slot, done_obs = data
+          obs, reward, done, info = env.step(action)
+          if done and auto_reset:
+            obs = env.reset()
+          elif done and not done_obs:
+            obs = None  # Not sent, so a lazy observation is never rendered.
+          conn.send(('ok', (send_obs(obs, slot), reward, done, info)))
+        elif cmd == 'reset':
+          seed, slot = data
+          if seed is not None:
+            np.random.seed(seed)
+            env.seed(seed)
+          conn.send(('ok', send_obs(env.reset(), slot)))
+        elif cmd == 'spaces':
+          conn.send(('ok', (env.observation_space, env.action_space)))
+        elif cmd == 'attach':
+          specs, env_index = data
+          obs_buffer = SharedObservationBuffer(specs)
+          conn.send(('ok', None))
+        elif cmd == 'close':
+          break
+        else:
+          raise ValueError(f'Unknown command: {cmd}')
+      except Exception:  # pylint: disable=broad-except
+        conn.send(('error', traceback.format_exc()))
+  finally:
+    if obs_buffer is not None:
+      obs_buffer.close()
+    env.close()
+    conn.close()
+
+
+def stack_obs(obs_list):
+  """Stack per-environment observations into one batched observation.
+
+  Args:
+    obs_list: list of observation dicts, each mapping keys to tuples of arrays
+      (e.g. one array per camera).
+
+  Returns:
+    dict with the same keys, mapping to tuples of arrays with a leading batch
+      dimension.
+  """
+  return {
+      key: tuple(np.stack([obs[key][i] for obs in obs_list])
+                 for i in range(len(obs_list[0][key])))
+      for key in obs_list[0]
+  }
+
+
+def split_obs(obs):
+  """Split a batched observation into a list of per-environment views."""
+  n_envs = len(next(iter(obs.values()))[0])
+  return [{key: tuple(x[i] for x in value) for key, value in obs.items()}
+          for i in range(n_envs)]
+
+
+class VectorEnvironment:
+  """Runs N environments in worker processes and steps them as a batch."""
+
+  def __init__(self,
+               env_fns,
+               auto_reset=False,
+               start_method='spawn',
+               shared_obs=False,
+               n_slots=2):
+    """Starts one worker process per environment.
+
+    Args:
+      env_fns: list of callables, each building an `Environment` (or
+        `ContinuousEnvironment`) with its task already set. They are sent to
+        the workers, so they must be picklable with `start_method`.
+      auto_reset: if True, an environment that reports `done` is reset right
+        away and the returned observation is the first one of the new episode.
+        The reward, done flag and info still describe the finished episode.
+      start_method: multiprocessing start method. Defaults to 'spawn' since
+        forking after TensorFlow or PyBullet have been initialized is unsafe.
+      shared_obs: if True, workers write observations into preallocated
+        shared-memory buffers (see `SharedObservationBuffer`) and `reset` and
+        `step` return views into them instead of unpickled copies.
+      n_slots: number of observation slots in the shared-memory ring. The
+        observation returned by a call stays valid for the next `n_slots - 1`
+        calls to `reset` or `step`; copy it to keep it longer.
+    """
+    self.num_envs = len(env_fns)
+    self.auto_reset = auto_reset
+    ctx = multiprocessing.get_context(start_method)
+    self._conns, self._procs = [], []
+    for env_fn in env_fns:
+      parent_conn, child_conn = ctx.Pipe()
+      proc = ctx.Process(
+          target=_worker, args=(child_conn, env_fn, auto_reset), daemon=True)
+      proc.start()
+      child_conn.close()
+      self._conns.append(parent_conn)
+      self._procs.append(proc)
+    self._closed = False
+
+    self._send(0, 'spaces')
+    self.observation_space, self.action_space = self._recv(0)
+
+    self._obs_buffer = None
+    self._n_slots = n_slots
+    self._slot = 0
+    if shared_obs:
+      self._obs_buffer = SharedObservationBuffer.from_space(
+          self.observation_space, self.num_envs, n_slots)
+      for i in range(self.num_envs):
+        self._send(i, 'attach', (self._obs_buffer.specs, i))
+      for i in range(self.num_envs):
+        self._recv(i)
+
+  def _send(self, i, cmd, data=None):
+    self._conns[i].send((cmd, data))
+
+  def _recv(self, i):
+    status, data = self._conns[i].recv()
+    if status == 'error':
+      raise RuntimeError(f'Environment worker {i} failed:\n{data}')
+    return data
+
+  def _next_slot(self):
+    slot = self._slot
+    self._slot = (self._slot + 1) % self._n_slots
+    return slot
+
+  def _zero_obs(self):
+    return {key: tuple(np.zeros(box.shape, box.dtype) for box in space.spaces)
+            for key, space in self.observation_space.spaces.items()}
+
+  def _batch_obs(self, obs, slot, indices, skipped=()):
+    if self._obs_buffer is None:
+      if skipped:
+        obs = list(obs)
+        for k in skipped:
+          obs[k] = self._zero_obs()
+      return stack_obs(obs)
+    for k in skipped:
+      self._obs_buffer.write(self._zero_obs(), slot, indices[k])
+    if list(indices) == list(range(self.num_envs)):
+      indices = None
+    return self._obs_buffer.read(slot, indices)
+
+  def reset(self, seeds=None, indices=None):
+    """Resets environments in parallel.
+
+    Args:
+      seeds: optional list of random seeds, one per reset environment. Each
+        worker seeds both NumPy's global generator and the environment.
+      indices: optional list of environment indices to reset. Defaults to all.
+
+    Returns:
+      batched observation, see `stack_obs`.
+    """
+    indices = range(self.num_envs) if indices is None else indices
+    seeds = [None] * len(indices) if seeds is None else seeds
+    if len(seeds) != len(indices):
+      raise ValueError('Expected one seed per environment.')
+    slot = self._next_slot()
+    for i, seed in zip(indices, seeds):
+      self._send(i, 'reset', (seed, slot))
+    return self._batch_obs([self._recv(i) for i in indices], slot, indices)
+
+  def step(self, actions, indices=None, done_obs=True):
+    """Steps environments in parallel.
+
+    Args:
+      actions: list of actions, one per stepped environment.
+      indices: optional list of environment indices to step. Defaults to all.
+      done_obs: if False, the last observation of an environment that reports
+        `done` is not sent back, so environments with lazy observations do
+        not render it, and its batch entry is zeros.
+        Has no effect with `auto_reset`, which never returns these
+        observations.
+
+    Returns:
+      (obs, reward, done, info) tuple, where obs is batched (see `stack_obs`),
+        reward and done are arrays and info is a list of dicts.
+    """
+    indices = range(self.num_envs) if indices is None else indices
+    if len(actions) != len(indices):
+      raise ValueError('Expected one action per environment.')
+    slot = self._next_slot()
+    for i, action in zip(indices, actions):
+      self._send(i, 'step', (action, slot, done_obs))
+    results = [self._recv(i) for i in indices]
+    obs, reward, done, info = zip(*results)
+    skipped = []
+    if not (done_obs or self.auto_reset):
+      skipped = [k for k, d in enumerate(done) if d]
+    obs = self._batch_obs(obs, slot, indices, skipped)
+    return obs, np.array(reward), np.array(done), list(info)
+
+  def close(self):
+    if self._closed:
+      return
+    for i, conn in enumerate(self._conns):
+      try:
+        self._send(i, 'close')
+      except (BrokenPipeError, EOFError):
+        pass
+      conn.close()
+    for proc in self._procs:
+      proc.join()
+    if self._obs_buffer is not None:
+      self._obs_buffer.close(unlink=True)
+    self._closed = True
@@ -3,6 +3,7 @@
 import os
 
 import numpy as np
+from src.utils import poses
 from src.utils import pybullet_utils
 
 import pybullet as p
@@ -15,8 +16,9 @@ SUCTION_HEAD_URDF = 'ur5/suction/suction-head.urdf'
 class Gripper:
   """Base gripper class."""
 
-  def __init__(self, assets_root):
+  def __init__(self, assets_root, pybullet_client):
     self.assets_root = assets_root
+    self.pybullet_client = pybullet_client
     self.activated = False
 
   def step(self):
@@ -34,15 +36,16 @@ class Gripper:
 class Spatula(Gripper):
   """Simulate simple spatula for pushing."""
 
-  def __init__(self, assets_root, robot, ee, obj_ids):  # pylint: disable=unused-argument
+  def __init__(self, assets_root, robot, ee, obj_ids, pybullet_client):  # pylint: disable=unused-argument
     """Creates spatula and 'attaches' it to the robot."""
-    super().__init__(assets_root)
+    super().__init__(assets_root, pybullet_client)
 
     # Load spatula model.
     pose = ((0.487, 0.109, 0.438), p.getQuaternionFromEuler((np.pi, 0, 0)))
     base = pybullet_utils.load_urdf(
-        p, os.path.join(self.assets_root, SPATULA_BASE_URDF), pose[0], pose[1])
-    p.createConstraint(
+        self.pybullet_client,
+        os.path.join(self.assets_root, SPATULA_BASE_URDF), pose[0], pose[1])
+    self.pybullet_client.createConstraint(
         parentBodyUniqueId=robot,
         parentLinkIndex=ee,
         childBodyUniqueId=base,
@@ -56,7 +59,7 @@ class Spatula(Gripper):
 class Suction(Gripper):
   """Simulate simple suction dynamics."""
 
-  def __init__(self, assets_root, robot, ee, obj_ids):
+  def __init__(self, assets_root, robot, ee, obj_ids, pybullet_client):
     """Creates suction and 'attaches' it to the robot.
 
     Has special cases when dealing with rigid vs deformables. For rigid,
@@ -80,14 +83,16 @@ class Suction(Gripper):
       robot: int representing PyBullet ID of robot.
       ee: int representing PyBullet ID of end effector link.
       obj_ids: list of PyBullet IDs of all suctionable objects in the env.
+      pybullet_client: PyBullet client of the environment owning the robot.
     """
-    super().__init__(assets_root)
+    super().__init__(assets_root, pybullet_client)
 
     # Load suction gripper base model (visual only).
     pose = ((0.487, 0.109, 0.438), p.getQuaternionFromEuler((np.pi, 0, 0)))
     base = pybullet_utils.load_urdf(
-        p, os.path.join(self.assets_root, SUCTION_BASE_URDF), pose[0], pose[1])
-    p.createConstraint(
+        self.pybullet_client,
+        os.path.join(self.assets_root, SUCTION_BASE_URDF), pose[0], pose[1])
+    self.pybullet_client.createConstraint(
         parentBodyUniqueId=robot,
         parentLinkIndex=ee,
         childBodyUniqueId=base,
@@ -101,8 +106,9 @@ class Suction(Gripper):
     # urdf = 'assets/ur5/suction/suction-head.urdf'
     pose = ((0.487, 0.109, 0.347), p.getQuaternionFromEuler((np.pi, 0, 0)))
     self.body = pybullet_utils.load_urdf(
-        p, os.path.join(self.assets_root, SUCTION_HEAD_URDF), pose[0], pose[1])
-    constraint_id = p.createConstraint(
+        self.pybullet_client,
+        os.path.join(self.assets_root, SUCTION_HEAD_URDF), pose[0], pose[1])
+    constraint_id = self.pybullet_client.createConstraint(
         parentBodyUniqueId=robot,
         parentLinkIndex=ee,
         childBodyUniqueId=self.body,
@@ -111,7 +117,7 @@ class Suction(Gripper):
         jointAxis=(0, 0, 0),
         parentFramePosition=(0, 0, 0),
         childFramePosition=(0, 0, -0.08))
-    p.changeConstraint(constraint_id, maxForce=50)
+    self.pybullet_client.changeConstraint(constraint_id, maxForce=50)
 
     # Reference to object IDs in environment for simulating suction.
     self.obj_ids = obj_ids
@@ -146,7 +152,8 @@ class Suction(Gripper):
     # del def_ids
 
     if not self.activated:
-      points = p.getContactPoints(bodyA=self.body, linkIndexA=0)
+      points = self.pybullet_client.getContactPoints(
+          bodyA=self.body, linkIndexA=0)
       # print(points)
       if points:
 
@@ -154,13 +161,12 @@ class Suction(Gripper):
         for point in points:
           obj_id, contact_link = point[2], point[4]
         if obj_id in self.obj_ids['rigid']:
-          body_pose = p.getLinkState(self.body, 0)
-          obj_pose = p.getBasePositionAndOrientation(obj_id)
-          world_to_body = p.invertTransform(body_pose[0], body_pose[1])
-          obj_to_body = p.multiplyTransforms(world_to_body[0],
-                                             world_to_body[1],
-                                             obj_pose[0], obj_pose[1])
-          self.contact_constraint = p.createConstraint(
+          body_pose = self.pybullet_client.getLinkState(self.body, 0)
+          obj_pose = self.pybullet_client.getBasePositionAndOrientation(obj_id)
+          world_to_body = poses.invert(poses.as_array(body_pose))
+          obj_to_body = poses.unpack(
+              poses.multiply(world_to_body, poses.as_array(obj_pose)))
+          self.contact_constraint = self.pybullet_client.createConstraint(
               parentBodyUniqueId=self.body,
               parentLinkIndex=0,
               childBodyUniqueId=obj_id,
@@ -191,7 +197,7 @@ class Suction(Gripper):
       # Release gripped rigid object (if any).
       if self.contact_constraint is not None:
         try:
-          p.removeConstraint(self.contact_constraint)
+          self.pybullet_client.removeConstraint(self.contact_constraint)
           self.contact_constraint = None
         except:  # pylint: disable=bare-except
           pass
@@ -201,7 +207,7 @@ class Suction(Gripper):
       # Release gripped deformable object (if any).
       if self.def_grip_anchors:
         for anchor_id in self.def_grip_anchors:
-          p.removeConstraint(anchor_id)
+          self.pybullet_client.removeConstraint(anchor_id)
         self.def_grip_anchors = []
         self.def_grip_item = None
         self.def_min_vetex = None
@@ -212,14 +218,14 @@ class Suction(Gripper):
     body, link = self.body, 0
     if self.activated and self.contact_constraint is not None:
       try:
-        info = p.getConstraintInfo(self.contact_constraint)
+        info = self.pybullet_client.getConstraintInfo(self.contact_constraint)
         body, link = info[2], info[3]
       except:  # pylint: disable=bare-except
         self.contact_constraint = None
         pass
 
     # Get all contact points between the suction and a rigid body.
-    points = p.getContactPoints(bodyA=body, linkIndexA=link)
+    points = self.pybullet_client.getContactPoints(bodyA=body, linkIndexA=link)
     # print(points)
     # exit()
     if self.activated:
@@ -236,5 +242,6 @@ class Suction(Gripper):
 
     suctioned_object = None
     if self.contact_constraint is not None:
-      suctioned_object = p.getConstraintInfo(self.contact_constraint)[2]
+      suctioned_object = self.pybullet_client.getConstraintInfo(
+          self.contact_constraint)[2]
     return suctioned_object is not None
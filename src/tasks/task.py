@@ -12,6 +12,7 @@ from src.tasks import cameras
 from src.tasks import planners
 from src.tasks import primitives
 from src.tasks.grippers import Suction
+from src.utils import poses
 from src.utils import utils
 
 import six
@@ -37,6 +38,11 @@ class Task():
       self.primitive = primitives.PickPlace()
     self.oracle_cams = cameras.Oracle.CONFIG
 
+    # Render oracle heightmaps with an orthographic camera instead of
+    # reconstructing them from point clouds. Faster, but objects are placed
+    # differently for the same seed (see `get_true_image`).
+    self.orthographic_oracle = False
+
     # Evaluation epsilons (for pose evaluation metric).
     self.pos_eps = 0.01
     self.rot_eps = np.deg2rad(15)
@@ -50,6 +56,7 @@ class Task():
     self._rewards = 0
 
     self.assets_root = None
+    self.pybullet_client = None
 
   def reset(self, env):  # pylint: disable=unused-argument
     if not self.assets_root:
@@ -111,7 +118,7 @@ class Task():
         # Ignore already matched objects.
         for i in range(len(objs)):
           object_id, (symmetry, _) = objs[i]
-          pose = p.getBasePositionAndOrientation(object_id)
+          pose = self.pybullet_client.getBasePositionAndOrientation(object_id)
           targets_i = np.argwhere(matches[i, :]).reshape(-1)
           for j in targets_i:
             if self.is_match(pose, targs[j], symmetry):
@@ -123,7 +130,7 @@ class Task():
       nn_targets = []
       for i in range(len(objs)):
         object_id, (symmetry, _) = objs[i]
-        xyz, _ = p.getBasePositionAndOrientation(object_id)
+        xyz, _ = self.pybullet_client.getBasePositionAndOrientation(object_id)
         targets_i = np.argwhere(matches[i, :]).reshape(-1)
         if len(targets_i) > 0:  # pylint: disable=g-explicit-length-test
           targets_xyz = np.float32([targs[j][0] for j in targets_i])
@@ -169,7 +176,8 @@ class Task():
 
       # Get placing pose.
       targ_pose = targs[nn_targets[pick_i]]  # pylint: disable=undefined-loop-variable
-      obj_pose = p.getBasePositionAndOrientation(objs[pick_i][0])  # pylint: disable=undefined-loop-variable
+      obj_pose = self.pybullet_client.getBasePositionAndOrientation(
+          objs[pick_i][0])  # pylint: disable=undefined-loop-variable
       if not self.sixdof:
         obj_euler = utils.quatXYZW_to_eulerXYZ(obj_pose[1])
         obj_quat = utils.eulerXYZ_to_quatXYZW((0, 0, obj_euler[2]))
@@ -213,7 +221,7 @@ class Task():
         step_reward = 0
         for i in range(len(objs)):
           object_id, (symmetry, _) = objs[i]
-          pose = p.getBasePositionAndOrientation(object_id)
+          pose = self.pybullet_client.getBasePositionAndOrientation(object_id)
           targets_i = np.argwhere(matches[i, :]).reshape(-1)
           for j in targets_i:
             target_pose = targs[j]
@@ -225,15 +233,20 @@ class Task():
       elif metric == 'zone':
         zone_pts, total_pts = 0, 0
         obj_pts, zones = params
+        obj_poses = np.array([
+            poses.as_array(
+                self.pybullet_client.getBasePositionAndOrientation(obj_id))
+            for obj_id in obj_pts]).reshape(-1, 7)
         for zone_pose, zone_size in zones:
 
+          # Transform all objects into the zone frame at once.
+          world_to_zone = poses.invert(poses.as_array(zone_pose))
+          obj_to_zone = poses.multiply(world_to_zone, obj_poses)
+
           # Count valid points in zone.
-          for obj_id in obj_pts:
+          for obj_id, pose in zip(obj_pts, obj_to_zone):
             pts = obj_pts[obj_id]
-            obj_pose = p.getBasePositionAndOrientation(obj_id)
-            world_to_zone = utils.invert(zone_pose)
-            obj_to_zone = utils.multiply(world_to_zone, obj_pose)
-            pts = np.float32(utils.apply(obj_to_zone, pts))
+            pts = np.float32(utils.apply(poses.unpack(pose), pts))
             if len(zone_size) > 1:
               valid_pts = np.logical_and.reduce([
                   pts[0, :] > -zone_size[0] / 2, pts[0, :] < zone_size[0] / 2,
@@ -305,7 +318,15 @@ class Task():
     return (dist_pos < self.pos_eps) and (diff_rot < self.rot_eps)
 
   def get_true_image(self, env):
-    """Get RGB-D orthographic heightmaps and segmentation masks."""
+    """Get RGB-D orthographic heightmaps and segmentation masks.
+
+    `get_random_pose` samples object poses from these images, so a seed only
+    reproduces the scene of a dataset episode with the same
+    `orthographic_oracle` setting as the one the dataset was collected with.
+    """
+    if self.orthographic_oracle:
+      return env.render_heightmap(self.oracle_cams[0], self.bounds,
+                                  self.pix_size)
 
     # Capture near-orthographic RGB-D images and segmentation masks.
     color, depth, segm = env.render_camera(self.oracle_cams[0])
@@ -379,7 +400,7 @@ class Task():
     return tuple(size)
 
   def get_object_points(self, obj):
-    obj_shape = p.getVisualShapeData(obj)
+    obj_shape = self.pybullet_client.getVisualShapeData(obj)
     obj_dim = obj_shape[0][3]
     xv, yv, zv = np.meshgrid(
         np.arange(-obj_dim[0] / 2, obj_dim[0] / 2, 0.02),
@@ -391,11 +412,14 @@ class Task():
   def color_random_brown(self, obj):
     shade = np.random.rand() + 0.5
     color = np.float32([shade * 156, shade * 117, shade * 95, 255]) / 255
-    p.changeVisualShape(obj, -1, rgbaColor=color)
+    self.pybullet_client.changeVisualShape(obj, -1, rgbaColor=color)
 
   def set_assets_root(self, assets_root):
     self.assets_root = assets_root
 
+  def set_pybullet_client(self, pybullet_client):
+    self.pybullet_client = pybullet_client
+
 
 class ContinuousOracle:
   """Continuous oracle."""
@@ -1,5 +1,6 @@
 """main training script."""
 
+import functools
 import os
 import pickle
 
@@ -10,6 +11,9 @@ from src import agents
 from src import dataset
 from src import tasks
 from src.environments.environment import Environment
+from src.environments.vector_environment import split_obs
+from src.environments.vector_environment import VectorEnvironment
+from src.tasks import cameras
 import tensorflow as tf
 
 flags.DEFINE_string('root_dir', '.', '')
@@ -24,10 +28,82 @@ flags.DEFINE_integer('n_steps', 40000, '')
 flags.DEFINE_integer('n_runs', 1, '')
 flags.DEFINE_integer('gpu', 0, '')
 flags.DEFINE_integer('gpu_limit', None, '')
+flags.DEFINE_integer('n_envs', 1, 'Number of environments run in parallel.')
+flags.DEFINE_bool('fast_reset', False, 'Restore a scene snapshot on reset.')
+flags.DEFINE_string('render_profile', None, 'Render profile of agent cameras.')
+flags.DEFINE_bool('lazy_obs', False, 'Skip rendering unread observations.')
+flags.DEFINE_bool('orthographic_oracle', False, 'Render oracle heightmaps '
+                  'with an orthographic camera. Faster, but seeds produce '
+                  'other scenes than in datasets collected without it.')
 
 FLAGS = flags.FLAGS
 
 
+def make_env(assets_root, disp, shared_memory, fast_reset, render_profile,
+             lazy_obs, orthographic_oracle, task_name):
+  """Builds a test environment, in this or in a worker process."""
+  env = Environment(
+      assets_root,
+      disp=disp,
+      shared_memory=shared_memory,
+      hz=480,
+      fast_reset=fast_reset,
+      render_profile=render_profile,
+      lazy_obs=lazy_obs)
+  task = tasks.names[task_name]()
+  task.mode = 'test'
+  task.orthographic_oracle = orthographic_oracle
+  env.set_task(task)
+  return env
+
+
+def run_episode(env, agent, goal, seed, max_steps):
+  """Runs one test episode in an in-process environment.
+
+  Returns:
+    (total_reward, info) tuple of the episode's last transition.
+  """
+  np.random.seed(seed)
+  env.seed(seed)
+  obs = env.reset()
+  info = None
+  total_reward = 0
+  for _ in range(max_steps):
+    act = agent.act(obs, info, goal)
+    obs, reward, done, info = env.step(act)
+    total_reward += float(reward)
+    print(f'Total Reward: {total_reward} Done: {done}')
+    if done:
+      break
+  return total_reward, info
+
+
+def run_episodes(env, agent, goals, seeds, max_steps):
+  """Runs one test episode per environment of a `VectorEnvironment`.
+
+  Returns:
+    list of (total_reward, info) tuples of the episodes' last transitions.
+  """
+  active = list(range(len(seeds)))
+  obs = split_obs(env.reset(seeds, indices=active))
+  infos = [None] * len(seeds)
+  total_rewards = [0] * len(seeds)
+  for _ in range(max_steps):
+    acts = [agent.act(obs[k], infos[k], goals[k]) for k in active]
+    # Last observations of finished episodes are never read.
+    batch_obs, reward, done, info = env.step(
+        acts, indices=active, done_obs=False)
+    for k, o, r, d, i in zip(active, split_obs(batch_obs), reward, done,
+                             info):
+      obs[k], infos[k] = o, i
+      total_rewards[k] += float(r)
+      print(f'Total Reward: {total_rewards[k]} Done: {d}')
+    active = [k for k, d in zip(active, done) if not d]
+    if not active:
+      break
+  return list(zip(total_rewards, infos))
+
+
 def main(unused_argv):
   # Configure which GPU to use.
   cfg = tf.config.experimental
@@ -43,14 +119,18 @@ def main(unused_argv):
     dev_cfg = [cfg.VirtualDeviceConfiguration(memory_limit=mem_limit)]
     cfg.set_virtual_device_configuration(gpus[0], dev_cfg)
 
-  # Initialize environment and task.
-  env = Environment(
-      FLAGS.assets_root,
-      disp=FLAGS.disp,
-      shared_memory=FLAGS.shared_memory,
-      hz=480)
+  # Initialize environments and task.
+  env_fn = functools.partial(make_env, FLAGS.assets_root, FLAGS.disp,
+                             FLAGS.shared_memory, FLAGS.fast_reset,
+                             FLAGS.render_profile, FLAGS.lazy_obs,
+                             FLAGS.orthographic_oracle, FLAGS.task)
+  # A single environment runs in this process, e.g. to keep the --disp GUI
+  # in the main process; more run in parallel worker processes.
+  if FLAGS.n_envs == 1:
+    env = env_fn()
+  else:
+    env = VectorEnvironment([env_fn] * FLAGS.n_envs)
   task = tasks.names[FLAGS.task]()
-  task.mode = 'test'
 
   # Load test dataset.
   ds = dataset.Dataset(os.path.join(FLAGS.data_dir, f'{FLAGS.task}-test'))
@@ -63,6 +143,11 @@ def main(unused_argv):
     np.random.seed(train_run)
     tf.random.set_seed(train_run)
     agent = agents.names[FLAGS.agent](name, FLAGS.task, FLAGS.root_dir)
+    if FLAGS.render_profile is not None:
+      agent.cam_config = [
+          cameras.apply_profile(config, FLAGS.render_profile)
+          for config in agent.cam_config
+      ]
 
     # # Run testing every interval.
     # for train_step in range(0, FLAGS.n_steps + 1, FLAGS.interval):
@@ -71,27 +156,22 @@ def main(unused_argv):
     if FLAGS.n_steps > 0:
       agent.load(FLAGS.n_steps)
 
-    # Run testing and save total rewards with last transition info.
+    # Run testing (one episode per environment at a time) and save total
+    # rewards with last transition info.
     results = []
-    for i in range(ds.n_episodes):
-      print(f'Test: {i + 1}/{ds.n_episodes}')
-      episode, seed = ds.load(i)
-      goal = episode[-1]
-      total_reward = 0
-      np.random.seed(seed)
-      env.seed(seed)
-      env.set_task(task)
-      obs = env.reset()
-      info = None
-      reward = 0
-      for _ in range(task.max_steps):
-        act = agent.act(obs, info, goal)
-        obs, reward, done, info = env.step(act)
-        total_reward += reward
-        print(f'Total Reward: {total_reward} Done: {done}')
-        if done:
-          break
-      results.append((total_reward, info))
+    for start in range(0, ds.n_episodes, FLAGS.n_envs):
+      ids = range(start, min(start + FLAGS.n_envs, ds.n_episodes))
+      goals, seeds = [], []
+      for i in ids:
+        print(f'Test: {i + 1}/{ds.n_episodes}')
+        goals.append(ds.load_step(i, -1))
+        seeds.append(ds.episode_seed(i))
+      if FLAGS.n_envs == 1:
+        results.append(run_episode(env, agent, goals[0], seeds[0],
+                                   task.max_steps))
+      else:
+        results.extend(run_episodes(env, agent, goals, seeds,
+                                    task.max_steps))
 
       # Save results.
       with tf.io.gfile.GFile(
@@ -99,6 +179,8 @@ def main(unused_argv):
           'wb') as f:
         pickle.dump(results, f)
 
+  env.close()
+
 
 if __name__ == '__main__':
   app.run(main)
@@ -1,4 +1,5 @@
 import datetime
+import functools
 import os
 
 from absl import app
@@ -6,6 +7,7 @@ from absl import flags
 import numpy as np
 from src import agents
 from src.dataset import Dataset
+from src.dataset import Prefetcher
 import tensorflow as tf
 
 flags.DEFINE_string('train_dir', '.', '')
@@ -19,6 +21,11 @@ flags.DEFINE_integer('n_runs', 1, '')
 flags.DEFINE_integer('interval', 1000, '')
 flags.DEFINE_integer('gpu', 0, '')
 flags.DEFINE_integer('gpu_limit', None, '')
+flags.DEFINE_float('cache_gb', None, 'Byte budget of the train dataset cache.')
+flags.DEFINE_bool('pin_sample_set', False, 'Never evict training episodes.')
+flags.DEFINE_integer('prefetch_workers', 0, 'Background sampling workers.')
+flags.DEFINE_integer('prefetch_depth', 8, 'Samples prepared ahead of training.')
+flags.DEFINE_bool('prefetch_processes', False, 'Sample in processes.')
 
 FLAGS = flags.FLAGS
 
@@ -39,7 +46,11 @@ def main(unused_argv):
     cfg.set_virtual_device_configuration(gpus[0], dev_cfg)
 
   # Load train and test datasets.
-  train_dataset = Dataset(os.path.join(FLAGS.data_dir, f'{FLAGS.task}-train'))
+  cache_bytes = None
+  if FLAGS.cache_gb is not None:
+    cache_bytes = int(FLAGS.cache_gb * 1024**3)
+  train_dataset = Dataset(os.path.join(FLAGS.data_dir, f'{FLAGS.task}-train'),
+                          cache_bytes=cache_bytes)
   test_dataset = Dataset(os.path.join(FLAGS.data_dir, f'{FLAGS.task}-test'))
 
   # Run training from scratch multiple times.
@@ -60,14 +71,29 @@ def main(unused_argv):
     # Limit random sampling during training to a fixed dataset.
     max_demos = train_dataset.n_episodes
     episodes = np.random.choice(range(max_demos), FLAGS.n_demos, False)
-    train_dataset.set(episodes)
+    train_dataset.set(episodes, pin=FLAGS.pin_sample_set)
+
+    # Prepare training samples in the background if requested.
+    prefetcher = None
+    if FLAGS.prefetch_workers > 0:
+      prefetcher = Prefetcher(
+          functools.partial(agent.get_sample, train_dataset),
+          seed=train_run,
+          n_workers=FLAGS.prefetch_workers,
+          queue_depth=FLAGS.prefetch_depth,
+          processes=FLAGS.prefetch_processes)
 
     # Train agent and save snapshots.
     while agent.total_steps < FLAGS.n_steps:
       for _ in range(FLAGS.interval):
-        agent.train(train_dataset, writer)
+        sample = next(prefetcher) if prefetcher is not None else None
+        agent.train(train_dataset, writer, sample=sample)
       agent.validate(test_dataset, writer)
       agent.save()
+      if cache_bytes is not None:
+        print(f'Train dataset cache: {train_dataset.cache_info()}')
+    if prefetcher is not None:
+      prefetcher.close()
 
 if __name__ == '__main__':
   app.run(main)
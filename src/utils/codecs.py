@@ -0,0 +1,191 @@
+"""Field codecs for dataset storage."""
+
+import pickle
+import zlib
+
+import cv2
+import numpy as np
+
+try:
+  import lz4.frame as lz4_frame  # pylint: disable=g-import-not-at-top
+except ImportError:
+  lz4_frame = None
+
+
+#-----------------------------------------------------------------------------
+# ARRAY CODECS
+#-----------------------------------------------------------------------------
+
+# Array codecs store an episode's field as one memory-mapped array (the
+# dataset's 'array' layout) and decode slices of it on access.
+
+
+class Raw():
+  """Stores arrays as they are; decoding returns zero-copy views."""
+
+  layout = 'array'
+
+  def encode_array(self, x):
+    return x
+
+  def decode_array(self, x):
+    return x
+
+
+class UInt16mm():
+  """Lossy depth: stores meters as uint16 millimeters.
+
+  Halves the size of float32 depth, but quantizes it to 1mm, i.e. decoded
+  depths differ by up to 0.5mm. Depths beyond 65.535m are clipped.
+  """
+
+  layout = 'array'
+  scale = np.float32(0.001)
+
+  def encode_array(self, x):
+    x = np.round(np.asarray(x, dtype=np.float64) / 0.001)
+    return np.uint16(np.clip(x, 0, np.iinfo(np.uint16).max))
+
+  def decode_array(self, x):
+    return np.multiply(x, self.scale, dtype=np.float32)
+
+
+#-----------------------------------------------------------------------------
+# RECORD CODECS
+#-----------------------------------------------------------------------------
+
+# Record codecs encode each step of a field into bytes (the dataset's 'record'
+# layout).
+
+
+class Pickle():
+  """Pickles any Python object."""
+
+  layout = 'record'
+
+  def encode(self, x):
+    return pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
+
+  def decode(self, buf):
+    return pickle.loads(buf)
+
+
+class Zlib(Pickle):
+  """Pickles and compresses with zlib."""
+
+  def __init__(self, level=6):
+    self.level = int(level)
+
+  def encode(self, x):
+    return zlib.compress(super().encode(x), self.level)
+
+  def decode(self, buf):
+    return super().decode(zlib.decompress(buf))
+
+
+class LZ4(Pickle):
+  """Pickles and compresses with LZ4 frames (requires the lz4 package).
+
+  The optional level is lz4's `compression_level`: 0 (default) is fast
+  compression, 3 to 16 trade speed for size.
+  """
+
+  def __init__(self, level=0):
+    if lz4_frame is None:
+      raise ImportError('The lz4 codec requires the lz4 package.')
+    self.level = int(level)
+
+  def encode(self, x):
+    return lz4_frame.compress(super().encode(x), compression_level=self.level)
+
+  def decode(self, buf):
+    return super().decode(lz4_frame.decompress(buf))
+
+
+class Image():
+  """Encodes uint8 RGB images, or stacks of them, with OpenCV.
+
+  A step of shape (..., H, W, 3) is stored as one encoded image per HxWx3
+  slice, e.g. one per camera.
+  """
+
+  layout = 'record'
+
+  def __init__(self, ext, params=()):
+    self.ext = ext
+    self.params = list(params)
+
+  def encode(self, x):
+    x = np.asarray(x)
+    if x.dtype != np.uint8:
+      raise ValueError(f'Expected uint8 images, got {x.dtype}.')
+    images = x.reshape((-1,) + x.shape[-3:])
+    bufs = []
+    for image in images:
+      ok, buf = cv2.imencode(self.ext, image[Ellipsis, ::-1], self.params)
+      if not ok:
+        raise ValueError(f'Could not encode image as {self.ext}.')
+      bufs.append(buf.tobytes())
+    return pickle.dumps((x.shape, bufs), protocol=pickle.HIGHEST_PROTOCOL)
+
+  def decode(self, buf):
+    shape, bufs = pickle.loads(buf)
+    x = np.empty(shape, dtype=np.uint8)
+    images = x.reshape((-1,) + tuple(shape[-3:]))
+    for image, buf in zip(images, bufs):
+      bgr = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+      image[:] = bgr[Ellipsis, ::-1]
+    return x
+
+
+def png(level=3):
+  """Lossless PNG color."""
+  return Image('.png', (cv2.IMWRITE_PNG_COMPRESSION, int(level)))
+
+
+def jpeg(quality=95):
+  """Lossy JPEG color with a quality in [0, 100]."""
+  return Image('.jpg', (cv2.IMWRITE_JPEG_QUALITY, int(quality)))
+
+
+#-----------------------------------------------------------------------------
+# REGISTRY
+#-----------------------------------------------------------------------------
+
+# Codec specs are 'name' or 'name:param', e.g. 'jpeg:90', 'zlib:1' or 'lz4:9'.
+# The parameter is the quality of jpeg and the compression level of png, zlib
+# and lz4; other codecs take none.
+CODECS = {
+    'raw': Raw,
+    'uint16_mm': UInt16mm,
+    'pickle': Pickle,
+    'zlib': Zlib,
+    'lz4': LZ4,
+    'png': png,
+    'jpeg': jpeg,
+}
+
+# Codecs that accept a 'name:param' spec.
+PARAM_CODECS = ('zlib', 'lz4', 'png', 'jpeg')
+
+
+def get(spec):
+  """Returns the codec for a spec string such as 'png' or 'jpeg:90'."""
+  name, _, param = spec.partition(':')
+  if name not in CODECS:
+    raise ValueError(f'Unknown codec: {spec}')
+  if not param:
+    return CODECS[name]()
+  if name not in PARAM_CODECS:
+    raise ValueError(f'Codec {name} takes no parameter: {spec}')
+  return CODECS[name](param)
+
+
+def parse_field_specs(items):
+  """Parses 'field:codec' strings, e.g. from a list flag, into a dict."""
+  specs = {}
+  for item in items:
+    field, _, spec = item.partition(':')
+    get(spec)  # Fail early on unknown codecs.
+    specs[field] = spec
+  return specs
@@ -0,0 +1,274 @@
+"""Batched SE(3) pose math in NumPy.
+
+Poses are float64 arrays of shape (..., 7): a position followed by a
+quaternion in xyzw order, as in pybullet. Leading dimensions broadcast, so one
+call composes, inverts or applies a whole batch of poses. No physics client is
+needed.
+
+The arithmetic follows Bullet and transforms3d operation by operation, so
+results are identical to `pybullet.invertTransform`,
+`pybullet.multiplyTransforms`, `pybullet.getMatrixFromQuaternion` and the
+transforms3d 'szxy' Euler conversions used by `utils`. Like pybullet's
+transforms, `invert`, `multiply` and `apply` compute in single precision and
+return float64 arrays.
+"""
+
+import math
+
+import numpy as np
+
+# Threshold of transforms3d.euler for gimbal lock.
+_EPS4 = np.finfo(np.float64).eps * 4.0
+
+# Bullet's btScalar in pybullet's transforms.
+_SCALAR = np.float32
+
+
+def _libm(func, *args):
+  """Applies a `math` function elementwise.
+
+  transforms3d uses the C library's cos, sin and atan2, which can differ from
+  NumPy's vectorized versions in the last bit.
+  """
+  return np.asarray(np.frompyfunc(func, len(args), 1)(*args), dtype=np.float64)
+
+
+#-----------------------------------------------------------------------------
+# POSE ARRAYS
+#-----------------------------------------------------------------------------
+
+
+def pack(position, quaternion):
+  """Stacks positions (..., 3) and xyzw quaternions (..., 4) into poses."""
+  position = np.asarray(position, dtype=np.float64)
+  quaternion = np.asarray(quaternion, dtype=np.float64)
+  shape = np.broadcast_shapes(position.shape[:-1], quaternion.shape[:-1])
+  return np.concatenate((np.broadcast_to(position, shape + (3,)),
+                         np.broadcast_to(quaternion, shape + (4,))), axis=-1)
+
+
+def unpack(pose):
+  """Splits poses (..., 7) into positions (..., 3) and quaternions (..., 4)."""
+  pose = np.asarray(pose, dtype=np.float64)
+  return pose[Ellipsis, :3], pose[Ellipsis, 3:]
+
+
+def as_array(pose):
+  """Converts a (position, quaternion) pose or a pose array to (..., 7)."""
+  if isinstance(pose, np.ndarray) and pose.shape[-1:] == (7,):
+    return np.asarray(pose, dtype=np.float64)
+  return pack(pose[0], pose[1])
+
+
+#-----------------------------------------------------------------------------
+# ROTATIONS
+#-----------------------------------------------------------------------------
+
+
+def _rotation(x, y, z, w, s):
+  """Rotation matrices of quaternions with precomputed scale 2/|q|^2."""
+  xs, ys, zs = x * s, y * s, z * s
+  wx, wy, wz = w * xs, w * ys, w * zs
+  xx, xy, xz = x * xs, x * ys, x * zs
+  yy, yz, zz = y * ys, y * zs, z * zs
+  rotation = np.stack([
+      1.0 - (yy + zz), xy - wz, xz + wy,
+      xy + wz, 1.0 - (xx + zz), yz - wx,
+      xz - wy, yz + wx, 1.0 - (xx + yy)], axis=-1)
+  return rotation.reshape(rotation.shape[:-1] + (3, 3))
+
+
+def quat_to_matrix(quaternion, dtype=np.float64):
+  """Converts xyzw quaternions (..., 4) to rotation matrices (..., 3, 3).
+
+  Quaternions do not need to be normalized.
+
+  Args:
+    quaternion: array of xyzw quaternions.
+    dtype: floating point type of the computation.
+
+  Returns:
+    rotation: array of rotation matrices.
+  """
+  x, y, z, w = np.moveaxis(np.asarray(quaternion, dtype=dtype), -1, 0)
+  s = dtype(2.0) / (x * x + y * y + z * z + w * w)
+  return _rotation(x, y, z, w, s)
+
+
+def matrix_to_quat(rotation):
+  """Converts rotation matrices (..., 3, 3) to xyzw quaternions (..., 4).
+
+  Uses Bullet's branches: the trace formula if the trace is positive, and the
+  formula of the largest diagonal element otherwise.
+
+  Args:
+    rotation: array of rotation matrices.
+
+  Returns:
+    quaternion: array of xyzw quaternions, of the same floating point type
+      as the rotation matrices.
+  """
+  m = np.asarray(rotation)
+  if not np.issubdtype(m.dtype, np.floating):
+    m = m.astype(np.float64)
+  m00, m01, m02 = m[Ellipsis, 0, 0], m[Ellipsis, 0, 1], m[Ellipsis, 0, 2]
+  m10, m11, m12 = m[Ellipsis, 1, 0], m[Ellipsis, 1, 1], m[Ellipsis, 1, 2]
+  m20, m21, m22 = m[Ellipsis, 2, 0], m[Ellipsis, 2, 1], m[Ellipsis, 2, 2]
+  trace = m00 + m11 + m22
+
+  # Evaluate every branch and select one per matrix. Unused branches may take
+  # square roots of negative numbers.
+  with np.errstate(invalid='ignore', divide='ignore'):
+    s = np.sqrt(trace + 1.0)
+    t = 0.5 / s
+    q = np.stack([(m21 - m12) * t, (m02 - m20) * t, (m10 - m01) * t, s * 0.5],
+                 axis=-1)
+    s = np.sqrt(m00 - m11 - m22 + 1.0)
+    t = 0.5 / s
+    q0 = np.stack([s * 0.5, (m10 + m01) * t, (m20 + m02) * t, (m21 - m12) * t],
+                  axis=-1)
+    s = np.sqrt(m11 - m22 - m00 + 1.0)
+    t = 0.5 / s
+    q1 = np.stack([(m01 + m10) * t, s * 0.5, (m21 + m12) * t, (m02 - m20) * t],
+                  axis=-1)
+    s = np.sqrt(m22 - m00 - m11 + 1.0)
+    t = 0.5 / s
+    q2 = np.stack([(m02 + m20) * t, (m12 + m21) * t, s * 0.5, (m10 - m01) * t],
+                  axis=-1)
+
+  # Otherwise Bullet picks the largest diagonal element, the first on ties.
+  use_q0 = (m00 >= m11) & (m00 >= m22)
+  use_q1 = (m00 < m11) & (m11 >= m22)
+  return np.select([(trace > 0)[Ellipsis, None], use_q0[Ellipsis, None],
+                    use_q1[Ellipsis, None]], [q, q0, q1], q2)
+
+
+def euler_to_quat(rotation):
+  """Converts xyz Euler angles (..., 3) to xyzw quaternions (..., 4).
+
+  Same convention as `utils.eulerXYZ_to_quatXYZW`: transforms3d's static
+  'szxy' axes applied to angles in (z, x, y) order.
+
+  Args:
+    rotation: array of rotations around the x, y and z axes.
+
+  Returns:
+    quaternion: float64 array of xyzw quaternions.
+  """
+  rotation = np.asarray(rotation, dtype=np.float64)
+  ai = rotation[Ellipsis, 2] / 2.0
+  aj = rotation[Ellipsis, 0] / 2.0
+  ak = rotation[Ellipsis, 1] / 2.0
+  ci, si = _libm(math.cos, ai), _libm(math.sin, ai)
+  cj, sj = _libm(math.cos, aj), _libm(math.sin, aj)
+  ck, sk = _libm(math.cos, ak), _libm(math.sin, ak)
+  cc, cs = ci * ck, ci * sk
+  sc, ss = si * ck, si * sk
+  return np.stack([cj * ss + sj * cc, cj * cs - sj * sc,
+                   cj * sc - sj * cs, cj * cc + sj * ss], axis=-1)
+
+
+def quat_to_euler(quaternion):
+  """Converts xyzw quaternions (..., 4) to xyz Euler angles (..., 3).
+
+  Inverse of `euler_to_quat`, as in `utils.quatXYZW_to_eulerXYZ`.
+
+  Args:
+    quaternion: array of xyzw quaternions, not necessarily normalized.
+
+  Returns:
+    rotation: float64 array of rotations around the x, y and z axes.
+  """
+  x, y, z, w = np.moveaxis(np.asarray(quaternion, dtype=np.float64), -1, 0)
+  norm = w * w + x * x + y * y + z * z
+  with np.errstate(divide='ignore'):
+    s = 2.0 / norm
+  m = _rotation(x, y, z, w, s)
+  m[norm < np.finfo(np.float64).eps] = np.eye(3)
+
+  cy = np.sqrt(m[Ellipsis, 2, 2] * m[Ellipsis, 2, 2] +
+               m[Ellipsis, 0, 2] * m[Ellipsis, 0, 2])
+  locked = cy <= _EPS4
+  rx = _libm(math.atan2, -m[Ellipsis, 1, 2], cy)
+  ry = np.where(locked, 0.0,
+                _libm(math.atan2, m[Ellipsis, 0, 2], m[Ellipsis, 2, 2]))
+  rz = np.where(locked, _libm(math.atan2, -m[Ellipsis, 0, 1], m[Ellipsis, 0, 0]),
+                _libm(math.atan2, m[Ellipsis, 1, 0], m[Ellipsis, 1, 1]))
+  return np.stack([rx, ry, rz], axis=-1)
+
+
+#-----------------------------------------------------------------------------
+# TRANSFORMS
+#-----------------------------------------------------------------------------
+
+
+def _rotate(rotation, points):
+  """Multiplies rotation matrices (..., 3, 3) with points (..., 3)."""
+  return (rotation[Ellipsis, 0] * points[Ellipsis, 0, None] +
+          rotation[Ellipsis, 1] * points[Ellipsis, 1, None] +
+          rotation[Ellipsis, 2] * points[Ellipsis, 2, None])
+
+
+def invert(pose):
+  """Inverts poses (..., 7), like `pybullet.invertTransform`."""
+  position, quaternion = unpack(pose)
+  rotation = np.swapaxes(quat_to_matrix(quaternion, _SCALAR), -1, -2)
+  position = _rotate(rotation, -position.astype(_SCALAR))
+  return pack(position, matrix_to_quat(rotation))
+
+
+def multiply(pose0, pose1):
+  """Composes poses (..., 7), like `pybullet.multiplyTransforms`.
+
+  Args:
+    pose0: array of poses, e.g. world_to_a.
+    pose1: array of poses broadcastable with pose0, e.g. a_to_b.
+
+  Returns:
+    pose: array of composed poses, e.g. world_to_b.
+  """
+  position0, quaternion0 = unpack(pose0)
+  position1, quaternion1 = unpack(pose1)
+  rotation0 = quat_to_matrix(quaternion0, _SCALAR)
+  rotation1 = quat_to_matrix(quaternion1, _SCALAR)
+  rotation = (rotation0[Ellipsis, :, 0, None] * rotation1[Ellipsis, None, 0, :] +
+              rotation0[Ellipsis, :, 1, None] * rotation1[Ellipsis, None, 1, :] +
+              rotation0[Ellipsis, :, 2, None] * rotation1[Ellipsis, None, 2, :])
+  position = (_rotate(rotation0, position1.astype(_SCALAR)) +
+              position0.astype(_SCALAR))
+  return pack(position, matrix_to_quat(rotation))
+
+
+def apply(pose, points):
+  """Transforms points (..., 3) by poses (..., 7), with broadcasting.
+
+  Args:
+    pose: array of poses, e.g. world_to_a.
+    points: array of points in frame a. One pose (7,) applies to a point set
+      (N, 3); a batch of poses (B, 1, 7) to point sets (B, N, 3).
+
+  Returns:
+    points: float64 array of the points in the world frame.
+  """
+  position, quaternion = unpack(pose)
+  points = np.asarray(points, dtype=_SCALAR)
+  points = (_rotate(quat_to_matrix(quaternion, _SCALAR), points) +
+            position.astype(_SCALAR))
+  return points.astype(np.float64)
+
+
+def pose_to_matrix(pose):
+  """Converts poses (..., 7) to homogeneous transforms (..., 4, 4)."""
+  position, quaternion = unpack(pose)
+  transform = np.zeros(position.shape[:-1] + (4, 4))
+  transform[Ellipsis, :3, :3] = quat_to_matrix(quaternion)
+  transform[Ellipsis, :3, 3] = position
+  transform[Ellipsis, 3, 3] = 1.0
+  return transform
+
+
+def matrix_to_pose(transform):
+  """Converts homogeneous transforms (..., 4, 4) to poses (..., 7)."""
+  transform = np.asarray(transform, dtype=np.float64)
+  return pack(transform[Ellipsis, :3, 3],
+              matrix_to_quat(transform[Ellipsis, :3, :3]))
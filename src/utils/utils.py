@@ -8,10 +8,10 @@ import meshcat.geometry as g
 import meshcat.transformations as mtf
 
 import numpy as np
+from src.tasks import cameras
+from src.utils import poses
 from transforms3d import euler
 
-import pybullet as p
-
 #-----------------------------------------------------------------------------
 # HEIGHTMAP UTILS
 #-----------------------------------------------------------------------------
@@ -33,28 +33,41 @@ def get_heightmap(points, colors, bounds, pixel_size):
   """
   width = int(np.round((bounds[0, 1] - bounds[0, 0]) / pixel_size))
   height = int(np.round((bounds[1, 1] - bounds[1, 0]) / pixel_size))
-  heightmap = np.zeros((height, width), dtype=np.float32)
-  colormap = np.zeros((height, width, colors.shape[-1]), dtype=np.uint8)
+  points = points.reshape(-1, 3)
+  colors = colors.reshape(-1, colors.shape[-1])
 
   # Filter out 3D points that are outside of the predefined bounds.
-  ix = (points[Ellipsis, 0] >= bounds[0, 0]) & (points[Ellipsis, 0] < bounds[0, 1])
-  iy = (points[Ellipsis, 1] >= bounds[1, 0]) & (points[Ellipsis, 1] < bounds[1, 1])
-  iz = (points[Ellipsis, 2] >= bounds[2, 0]) & (points[Ellipsis, 2] < bounds[2, 1])
-  valid = ix & iy & iz
-  points = points[valid]
-  colors = colors[valid]
-
-  # Sort 3D points by z-value, which works with array assignment to simulate
-  # z-buffering for rendering the heightmap image.
-  iz = np.argsort(points[:, -1])
-  points, colors = points[iz], colors[iz]
-  px = np.int32(np.floor((points[:, 0] - bounds[0, 0]) / pixel_size))
-  py = np.int32(np.floor((points[:, 1] - bounds[1, 0]) / pixel_size))
+  x, y, z = points[:, 0], points[:, 1], points[:, 2]
+  valid = (x >= bounds[0, 0]) & (x < bounds[0, 1])
+  valid &= (y >= bounds[1, 0]) & (y < bounds[1, 1])
+  valid &= (z >= bounds[2, 0]) & (z < bounds[2, 1])
+  valid = np.flatnonzero(valid)
+  x, y, z = x[valid], y[valid], z[valid]
+
+  # Linear heightmap index of every point.
+  px = np.int32(np.floor((x - bounds[0, 0]) / pixel_size))
+  py = np.int32(np.floor((y - bounds[1, 0]) / pixel_size))
   px = np.clip(px, 0, width - 1)
   py = np.clip(py, 0, height - 1)
-  heightmap[py, px] = points[:, 2] - bounds[2, 0]
-  for c in range(colors.shape[-1]):
-    colormap[py, px, c] = colors[:, c]
+  cells = py * width + px
+
+  # Simulate z-buffering with a scatter-max instead of sorting: each pixel
+  # keeps its highest point, and the last such point (in image order) on ties.
+  zmax = np.full(height * width, -np.inf, dtype=z.dtype)
+  np.maximum.at(zmax, cells, z)
+  top = np.flatnonzero(z == zmax[cells])
+  winner = np.full(height * width, -1, dtype=np.intp)
+  winner[cells[top]] = valid[top]
+  hit = np.flatnonzero(winner >= 0)
+  winner = winner[hit]
+
+  # Write height and all color channels of the winning points at once.
+  heightmap = np.zeros(height * width, dtype=np.float32)
+  colormap = np.zeros((height * width, colors.shape[-1]), dtype=np.uint8)
+  heightmap[hit] = points[winner, 2] - bounds[2, 0]
+  colormap[hit] = colors[winner]
+  heightmap = heightmap.reshape(height, width)
+  colormap = colormap.reshape(height, width, colors.shape[-1])
   return heightmap, colormap
 
 
@@ -97,18 +110,17 @@ def transform_pointcloud(points, transform):
 
 
 def reconstruct_heightmaps(color, depth, configs, bounds, pixel_size):
-  """Reconstruct top-down heightmap views from multiple 3D pointclouds."""
+  """Reconstruct top-down heightmap views from multiple 3D pointclouds.
+
+  Views may have leading batch dimensions, e.g. NxHxWxC color and NxHxW depth
+  images of N observations, which are reconstructed at once. Colors may have
+  any number C of channels. The result of each view is the same as
+  `get_heightmap` of its point cloud.
+  """
   heightmaps, colormaps = [], []
   for color, depth, config in zip(color, depth, configs):
-    intrinsics = np.array(config['intrinsics']).reshape(3, 3)
-    xyz = get_pointcloud(depth, intrinsics)
-    position = np.array(config['position']).reshape(3, 1)
-    rotation = p.getMatrixFromQuaternion(config['rotation'])
-    rotation = np.array(rotation).reshape(3, 3)
-    transform = np.eye(4)
-    transform[:3, :] = np.hstack((rotation, position))
-    xyz = transform_pointcloud(xyz, transform)
-    heightmap, colormap = get_heightmap(xyz, color, bounds, pixel_size)
+    heightmap, colormap = fuse_heightmaps([color], [depth], [config], bounds,
+                                          pixel_size)
     heightmaps.append(heightmap)
     colormaps.append(colormap)
   return heightmaps, colormaps
@@ -116,21 +128,69 @@ def reconstruct_heightmaps(color, depth, configs, bounds, pixel_size):
 
 def pix_to_xyz(pixel, height, bounds, pixel_size, skip_height=False):
   """Convert from pixel location on heightmap to 3D position."""
-  u, v = pixel
+  return tuple(pixels_to_xyz(pixel, height, bounds, pixel_size, skip_height))
+
+
+def xyz_to_pix(position, bounds, pixel_size):
+  """Convert from 3D position to pixel location on heightmap."""
+  return tuple(xyz_to_pixels(position, bounds, pixel_size).tolist())
+
+
+def pix_in_bounds(pixels, shape):
+  """Checks which (row, col) pixels of shape (..., 2) lie in an HxW image."""
+  pixels = np.asarray(pixels)
+  return np.all((pixels >= 0) & (pixels < np.array(shape[:2])), axis=-1)
+
+
+def pixels_to_xyz(pixels, height, bounds, pixel_size, skip_height=False):
+  """Convert pixel locations on heightmap to 3D positions.
+
+  Batched version of `pix_to_xyz`.
+
+  Args:
+    pixels: (..., 2) int array of (row, col) pixel locations.
+    height: HxW float array of heights (from lower z-bound) in meters.
+    bounds: 3x2 float array of heightmap bounds, see `get_heightmap`.
+    pixel_size: float defining size of each pixel in meters.
+    skip_height: if True, do not look up heights and set z to 0.
+
+  Returns:
+    positions: (..., 3) float array of 3D positions.
+
+  Raises:
+    ValueError: if heights are looked up for pixels outside of the heightmap.
+  """
+  pixels = np.asarray(pixels)
+  u, v = pixels[Ellipsis, 0], pixels[Ellipsis, 1]
   x = bounds[0, 0] + v * pixel_size
   y = bounds[1, 0] + u * pixel_size
-  if not skip_height:
-    z = bounds[2, 0] + height[u, v]
+  if skip_height:
+    z = np.zeros_like(x)
   else:
-    z = 0.0
-  return (x, y, z)
+    if not np.all(pix_in_bounds(pixels, height.shape)):
+      raise ValueError(f'Pixels outside of the {height.shape} heightmap.')
+    z = bounds[2, 0] + height[u, v]
+  return np.stack([x, y, z], axis=-1)
 
 
-def xyz_to_pix(position, bounds, pixel_size):
-  """Convert from 3D position to pixel location on heightmap."""
-  u = int(np.round((position[1] - bounds[1, 0]) / pixel_size))
-  v = int(np.round((position[0] - bounds[0, 0]) / pixel_size))
-  return (u, v)
+def xyz_to_pixels(positions, bounds, pixel_size):
+  """Convert 3D positions to pixel locations on heightmap.
+
+  Batched version of `xyz_to_pix`. Positions outside of the bounds map to
+  pixels outside of the heightmap, see `pix_in_bounds`.
+
+  Args:
+    positions: (..., 3) float array of 3D positions.
+    bounds: 3x2 float array of heightmap bounds, see `get_heightmap`.
+    pixel_size: float defining size of each pixel in meters.
+
+  Returns:
+    pixels: (..., 2) int array of (row, col) pixel locations.
+  """
+  positions = np.asarray(positions)
+  u = np.round((positions[Ellipsis, 1] - bounds[1, 0]) / pixel_size)
+  v = np.round((positions[Ellipsis, 0] - bounds[0, 0]) / pixel_size)
+  return np.int64(np.stack([u, v], axis=-1))
 
 
 def unproject_vectorized(uv_coordinates, depth_values,
@@ -212,19 +272,26 @@ def sample_distribution(prob, n_samples=1):
 #-------------------------------------------------------------------------
 
 
+def _as_tuple(pose):
+  """Converts a pose array (7,) to a (position, quaternion) tuple of floats."""
+  position, quaternion = poses.unpack(pose)
+  return tuple(position.tolist()), tuple(quaternion.tolist())
+
+
 def invert(pose):
-  return p.invertTransform(pose[0], pose[1])
+  return _as_tuple(poses.invert(poses.as_array(pose)))
 
 
 def multiply(pose0, pose1):
-  return p.multiplyTransforms(pose0[0], pose0[1], pose1[0], pose1[1])
+  return _as_tuple(poses.multiply(poses.as_array(pose0),
+                                  poses.as_array(pose1)))
 
 
 def apply(pose, position):
   position = np.float32(position)
   position_shape = position.shape
   position = np.float32(position).reshape(3, -1)
-  rotation = np.float32(p.getMatrixFromQuaternion(pose[1])).reshape(3, 3)
+  rotation = np.float32(poses.quat_to_matrix(pose[1]))
   translation = np.float32(pose[0]).reshape(3, 1)
   position = rotation @ position + translation
   return tuple(position.reshape(position_shape))
@@ -242,11 +309,7 @@ def eulerXYZ_to_quatXYZW(rotation):  # pylint: disable=invalid-name
   Returns:
     quaternion, in xyzw order, tuple of 4 floats
   """
-  euler_zxy = (rotation[2], rotation[0], rotation[1])
-  quaternion_wxyz = euler.euler2quat(*euler_zxy, axes='szxy')
-  q = quaternion_wxyz
-  quaternion_xyzw = (q[1], q[2], q[3], q[0])
-  return quaternion_xyzw
+  return tuple(poses.euler_to_quat(rotation))
 
 
 def quatXYZW_to_eulerXYZ(quaternion_xyzw):  # pylint: disable=invalid-name
@@ -261,11 +324,7 @@ def quatXYZW_to_eulerXYZ(quaternion_xyzw):  # pylint: disable=invalid-name
   Returns:
     rotation: a 3-parameter rotation, in xyz order, tuple of 3 floats
   """
-  q = quaternion_xyzw
-  quaternion_wxyz = np.array([q[3], q[0], q[1], q[2]])
-  euler_zxy = euler.quat2euler(quaternion_wxyz, axes='szxy')
-  euler_xyz = (euler_zxy[1], euler_zxy[2], euler_zxy[0])
-  return euler_xyz
+  return tuple(poses.quat_to_euler(quaternion_xyzw).tolist())
 
 
 def apply_transform(transform_to_from, points_from):
@@ -318,25 +377,162 @@ def preprocess(img):
   return img
 
 
+def fuse_heightmaps(color, depth, configs, bounds, pixel_size):
+  """Get a fused top-down heightmap from the RGB-D images of several views.
+
+  The points of all views are scattered into one accumulator per heightmap
+  pixel and view holding the height of the highest point (z-buffering as in
+  `get_heightmap`), from which the maximum height over views and the sum and
+  count of non-black view colors are reduced. This gives the same result as
+  fusing the separate heightmaps and colormaps of `reconstruct_heightmaps`,
+  without building them or the point clouds.
+
+  Colors may have any number of channels, e.g. RGB with a segmentation
+  channel; a color is black if all its channels are zero. Like
+  `get_heightmap`, values are stored as uint8.
+
+  Args:
+    color: list of V ...xHxWxC images, one per view, with the same leading
+      (batch) shape and number of channels.
+    depth: list of V ...xHxW float depth images aligned with color.
+    configs: list of V camera configs.
+    bounds: 3x2 float array of values (rows: X,Y,Z; columns: min,max) defining
+      region in 3D space to generate heightmap in world coordinates.
+    pixel_size: float defining size of each pixel in meters.
+
+  Returns:
+    heightmap: ...xH'xW' float32 array of the max height over views (from
+      lower z-bound) in meters.
+    colormap: ...xH'xW'xC uint8 array of the mean non-black color over views.
+
+  Raises:
+    ValueError: if views have different numbers of color channels.
+  """
+  n_channels = np.shape(color[0])[-1]
+  if any(np.shape(view_color)[-1] != n_channels for view_color in color):
+    raise ValueError('Expected the same number of color channels in all '
+                     f'views, got {[np.shape(c)[-1] for c in color]}.')
+  width = int(np.round((bounds[0, 1] - bounds[0, 0]) / pixel_size))
+  height = int(np.round((bounds[1, 1] - bounds[1, 0]) / pixel_size))
+  batch_shape = np.shape(depth[0])[:-2]
+  n_maps = int(np.prod(batch_shape))
+  n_views = len(configs)
+  n_cells = height * width
+
+  # Smallest float32 values >= bounds, which compare with float32 coordinates
+  # exactly like the float64 bounds do, without upcasting them.
+  limits = np.float32(bounds)
+  below = limits < bounds
+  limits[below] = np.nextafter(limits[below], np.float32(np.inf))
+
+  # Index every valid point by its (map, view, pixel) accumulator. Points are
+  # unprojected one coordinate at a time, exactly as `Camera.pointcloud`
+  # does, and colors are only gathered for the winning points.
+  keys, z, sources = [], [], []
+  for view, (view_depth, config) in enumerate(zip(depth, configs)):
+    camera = cameras.Camera.from_config(config)
+    rays = camera.rays.reshape(-1, 3)
+    view_depth = np.reshape(view_depth, (n_maps, len(rays)))
+    x, y, view_z = [
+        (view_depth * rays[:, i] + camera.position[i]).reshape(-1)
+        for i in range(3)]
+    valid = (x >= limits[0, 0]) & (x < limits[0, 1])
+    valid &= (y >= limits[1, 0]) & (y < limits[1, 1])
+    valid &= (view_z >= limits[2, 0]) & (view_z < limits[2, 1])
+    valid = np.flatnonzero(valid)
+    px = np.int32(np.floor((x[valid] - bounds[0, 0]) / pixel_size))
+    py = np.int32(np.floor((y[valid] - bounds[1, 0]) / pixel_size))
+    px = np.clip(px, 0, width - 1)
+    py = np.clip(py, 0, height - 1)
+    maps = valid // len(rays)
+    keys.append((maps * n_views + view) * n_cells + py * width + px)
+    z.append(view_z[valid])
+    sources.append(valid)
+  keys, z, sources = (np.concatenate(keys), np.concatenate(z),
+                      np.concatenate(sources))
+
+  # Scatter-max heights; the last of tied top points (in image order) of a
+  # view wins its color.
+  zmax = np.full(n_maps * n_views * n_cells, -np.inf, dtype=z.dtype)
+  np.maximum.at(zmax, keys, z)
+  top = np.flatnonzero(z == zmax[keys])
+  winner = np.full(n_maps * n_views * n_cells, -1, dtype=np.intp)
+  winner[keys[top]] = top
+  hit = np.flatnonzero(winner >= 0)
+  sources = sources[winner[hit]]
+  hit_views = (hit // n_cells) % n_views
+  values = np.empty((n_channels, len(hit)), dtype=np.uint8)
+  for view, view_color in enumerate(color):
+    hits = np.flatnonzero(hit_views == view)
+    view_sources = sources[hits]
+    view_color = np.reshape(view_color, (-1, n_channels))
+    for c in range(n_channels):
+      values[c, hits] = view_color[:, c][view_sources]
+
+  # Reduce over views: max height, and mean color of views with a non-black
+  # top point.
+  zmax = zmax.reshape(n_maps, n_views, n_cells).max(axis=1).reshape(-1)
+  heightmap = np.zeros(n_maps * n_cells, dtype=np.float32)
+  seen = np.flatnonzero(zmax > -np.inf)
+  heightmap[seen] = zmax[seen] - bounds[2, 0]
+  cells = (hit // (n_views * n_cells)) * n_cells + hit % n_cells
+  nonblack = np.bitwise_or.reduce(values, axis=0) > 0
+  count = np.bincount(cells[nonblack], minlength=n_maps * n_cells)
+  count[count == 0] = 1
+  colormap = np.empty((n_maps * n_cells, n_channels), dtype=np.uint8)
+  for c in range(n_channels):
+    total = np.bincount(cells, weights=values[c], minlength=n_maps * n_cells)
+    colormap[:, c] = np.round(total / count)
+  heightmap = heightmap.reshape(batch_shape + (height, width))
+  colormap = colormap.reshape(batch_shape + (height, width, n_channels))
+  return heightmap, colormap
+
+
 def get_fused_heightmap(obs, configs, bounds, pix_size):
-  """Reconstruct orthographic heightmaps with segmentation masks."""
-  heightmaps, colormaps = reconstruct_heightmaps(
-      obs['color'], obs['depth'], configs, bounds, pix_size)
-  colormaps = np.float32(colormaps)
-  heightmaps = np.float32(heightmaps)
-
-  # Fuse maps from different views.
-  valid = np.sum(colormaps, axis=3) > 0
-  repeat = np.sum(valid, axis=0)
-  repeat[repeat == 0] = 1
-  cmap = np.sum(colormaps, axis=0) / repeat[Ellipsis, None]
-  cmap = np.uint8(np.round(cmap))
-  hmap = np.max(heightmaps, axis=0)  # Max to handle occlusions.
+  """Reconstruct a fused orthographic heightmap and colormap from all views."""
+  hmap, cmap = fuse_heightmaps(obs['color'], obs['depth'], configs, bounds,
+                               pix_size)
   return cmap, hmap
 
 
+def get_fused_heightmaps(color, depth, configs, bounds, pix_size,
+                         chunk_size=1):
+  """Batched `get_fused_heightmap` of N observations.
+
+  Args:
+    color: NxVxHxWx3 uint8 array of the images of V cameras.
+    depth: NxVxHxW float array of depth images aligned with color.
+    configs: list of V camera configs.
+    bounds: 3x2 float array of the workspace bounds.
+    pix_size: float defining size of each pixel in meters.
+    chunk_size: number of observations fused at once. Temporary arrays grow
+      with it, and since fusion is memory-bound, chunks that overflow the CPU
+      caches are slower (see `benchmark_batch` in src/benchmark.py).
+
+  Returns:
+    cmaps: NxH'xW'x3 uint8 array of colormaps.
+    hmaps: NxH'xW' float32 array of heightmaps.
+  """
+  n = len(depth)
+  width = int(np.round((bounds[0, 1] - bounds[0, 0]) / pix_size))
+  height = int(np.round((bounds[1, 1] - bounds[1, 0]) / pix_size))
+  cmaps = np.empty((n, height, width, 3), dtype=np.uint8)
+  hmaps = np.empty((n, height, width), dtype=np.float32)
+  for start in range(0, n, chunk_size):
+    chunk = slice(start, start + chunk_size)
+    hmaps[chunk], cmaps[chunk] = fuse_heightmaps(
+        [color[chunk, i] for i in range(len(configs))],
+        [depth[chunk, i] for i in range(len(configs))],
+        configs, bounds, pix_size)
+  return cmaps, hmaps
+
+
 def get_image_transform(theta, trans, pivot=(0, 0)):
-  """Compute composite 2D rigid transformation matrix."""
+  """Compute composite 2D rigid transformation matrix.
+
+  A batch of angles of shape (...) and translations of shape (..., 2) gives a
+  batch of transforms of shape (..., 3, 3).
+  """
   # Get 2D rigid transformation matrix that rotates an image by theta (in
   # radians) around pivot (in pixels) and translates by trans vector (in
   # pixels)
@@ -344,9 +540,14 @@ def get_image_transform(theta, trans, pivot=(0, 0)):
                             [0., 0., 1.]])
   image_t_pivot = np.array([[1., 0., pivot[0]], [0., 1., pivot[1]],
                             [0., 0., 1.]])
-  transform = np.array([[np.cos(theta), -np.sin(theta), trans[0]],
-                        [np.sin(theta), np.cos(theta), trans[1]], [0., 0., 1.]])
-  return np.dot(image_t_pivot, np.dot(transform, pivot_t_image))
+  theta = np.asarray(theta)
+  transform = np.zeros(theta.shape + (3, 3))
+  transform[Ellipsis, 0, 0] = transform[Ellipsis, 1, 1] = np.cos(theta)
+  transform[Ellipsis, 0, 1] = -np.sin(theta)
+  transform[Ellipsis, 1, 0] = np.sin(theta)
+  transform[Ellipsis, :2, 2] = trans
+  transform[Ellipsis, 2, 2] = 1.
+  return image_t_pivot @ (transform @ pivot_t_image)
 
 
 def check_transform(image, pixel, transform):
@@ -366,21 +567,13 @@ def check_transform(image, pixel, transform):
 def get_se3_from_image_transform(theta, trans, pivot, heightmap, bounds,
                                  pixel_size):
   """Calculate SE3 from image transform."""
-  position_center = pix_to_xyz(
-      np.flip(np.int32(np.round(pivot))),
-      heightmap,
-      bounds,
-      pixel_size,
-      skip_height=False)
-  new_position_center = pix_to_xyz(
-      np.flip(np.int32(np.round(pivot + trans))),
-      heightmap,
-      bounds,
-      pixel_size,
-      skip_height=True)
-  # Don't look up the z height, it might get augmented out of frame
-  new_position_center = (new_position_center[0], new_position_center[1],
-                         position_center[2])
+  pixels = np.flip(np.int32(np.round([pivot, pivot + trans])), axis=-1)
+  position_center, new_position_center = pixels_to_xyz(
+      pixels, heightmap, bounds, pixel_size, skip_height=True)
+  # Only look up the z height of the pivot, the new center might get augmented
+  # out of frame.
+  position_center[2] = new_position_center[2] = pixels_to_xyz(
+      pixels[0], heightmap, bounds, pixel_size)[2]
 
   delta_position = np.array(new_position_center) - np.array(position_center)
 
@@ -400,52 +593,116 @@ def get_se3_from_image_transform(theta, trans, pivot, heightmap, bounds,
   return t_world_center, t_world_centernew
 
 
-def get_random_image_transform_params(image_size):
-  theta_sigma = 2 * np.pi / 6
-  theta = np.random.normal(0, theta_sigma)
+def get_random_image_transform_params(image_size, rng=None, size=None):
+  """Sample a random rotation, translation and pivot for an image.
+
+  Args:
+    image_size: (height, width) of the image.
+    rng: optional np.random.RandomState. Defaults to the global generator.
+    size: optional number of rotations and translations to sample at once.
+      They are the ones `size` consecutive calls without `size` would return.
 
+  Returns:
+    (theta, trans, pivot) tuple, see `get_image_transform`. With `size`,
+      theta has shape (size,) and trans has shape (size, 2).
+  """
+  rng = np.random if rng is None else rng
+  theta_sigma = 2 * np.pi / 6
   trans_sigma = np.min(image_size) / 6
-  trans = np.random.normal(0, trans_sigma, size=2)  # [x, y]
   pivot = (image_size[1] / 2, image_size[0] / 2)
+  if size is not None:
+    noise = rng.standard_normal((size, 3))
+    return theta_sigma * noise[:, 0], trans_sigma * noise[:, 1:], pivot
+  theta = rng.normal(0, theta_sigma)
+  trans = rng.normal(0, trans_sigma, size=2)  # [x, y]
   return theta, trans, pivot
 
 
-def perturb(input_image, pixels, set_theta_zero=False):
-  """Data augmentation on images."""
-  image_size = input_image.shape[:2]
-
-  # Compute random rigid transform.
-  while True:
-    theta, trans, pivot = get_random_image_transform_params(image_size)
-    if set_theta_zero:
-      theta = 0.
-    transform = get_image_transform(theta, trans, pivot)
-    transform_params = theta, trans, pivot
+# Maximum number of random transforms `perturb` checks at once, and maximum
+# number of batches it draws before falling back to the identity transform.
+PERTURB_BATCH_SIZE = 64
+PERTURB_MAX_BATCHES = 8
 
-    # Ensure pixels remain in the image after transform.
-    is_valid = True
-    new_pixels = []
-    new_rounded_pixels = []
-    for pixel in pixels:
-      pixel = np.float32([pixel[1], pixel[0], 1.]).reshape(3, 1)
 
-      rounded_pixel = np.int32(np.round(transform @ pixel))[:2].squeeze()
-      rounded_pixel = np.flip(rounded_pixel)
+def _transform_pixels(transforms, points, image_size):
+  """Transforms pixel labels by a batch of image transforms.
 
-      pixel = (transform @ pixel)[:2].squeeze()
-      pixel = np.flip(pixel)
+  Args:
+    transforms: Nx3x3 image transforms.
+    points: list of 3x1 (col, row, 1) pixel labels. Pixels are transformed
+      one at a time, so that each matches a single transform's.
+    image_size: (height, width) of the image.
 
-      in_fov_rounded = rounded_pixel[0] < image_size[0] and rounded_pixel[
-          1] < image_size[1]
-      in_fov = pixel[0] < image_size[0] and pixel[1] < image_size[1]
+  Returns:
+    (is_valid, pixels, rounded_pixels) tuple: whether each transform keeps all
+      labels in the image, and per label, the Nx2 transformed pixels.
+  """
+  is_valid = np.ones(len(transforms), dtype=bool)
+  new_pixels = []
+  new_rounded_pixels = []
+  for point in points:
+    new_point = transforms @ point
+    pixel = np.flip(new_point[:, :2, 0], axis=-1)
+    rounded_pixel = np.flip(np.int32(np.round(new_point))[:, :2, 0], axis=-1)
+    is_valid &= np.all((pixel >= 0) & (rounded_pixel >= 0) &
+                       (pixel < image_size) & (rounded_pixel < image_size),
+                       axis=-1)
+    new_pixels.append(pixel)
+    new_rounded_pixels.append(rounded_pixel)
+  return is_valid, new_pixels, new_rounded_pixels
+
+
+def perturb(input_image, pixels, set_theta_zero=False, rng=None):
+  """Data augmentation on images.
+
+  Samples random rigid transforms until one keeps all pixel labels in the
+  image. Candidates are drawn and checked in batches and the first valid one
+  is used: the same transform as when checking one candidate at a time, but
+  the random generator advances by whole batches. After
+  `PERTURB_MAX_BATCHES` batches without a valid candidate (e.g. for labels
+  on the image border), the image and labels are returned untransformed.
 
-      is_valid = is_valid and np.all(rounded_pixel >= 0) and np.all(
-          pixel >= 0) and in_fov_rounded and in_fov
+  Args:
+    input_image: HxWxC image.
+    pixels: list of (row, col) pixel labels that must stay in the image.
+    set_theta_zero: if True, only translate the image.
+    rng: optional np.random.RandomState. Defaults to the global generator.
 
-      new_pixels.append(pixel)
-      new_rounded_pixels.append(rounded_pixel)
-    if is_valid:
+  Returns:
+    (image, pixels, rounded_pixels, (theta, trans, pivot)) tuple of the
+      transformed image and labels and the transform parameters.
+  """
+  image_size = input_image.shape[:2]
+  rng = np.random if rng is None else rng
+  points = [np.float32([pixel[1], pixel[0], 1.]).reshape(3, 1)
+            for pixel in pixels]
+
+  # Compute random rigid transform. Batches start with a single candidate,
+  # which is often valid, and double in size up to `PERTURB_BATCH_SIZE`.
+  size = 1
+  for _ in range(PERTURB_MAX_BATCHES):
+    thetas, transes, pivot = get_random_image_transform_params(
+        image_size, rng, size=size)
+    if set_theta_zero:
+      thetas[:] = 0.
+    transforms = get_image_transform(thetas, transes, pivot)
+    is_valid, new_pixels, new_rounded_pixels = _transform_pixels(
+        transforms, points, image_size)
+    if np.any(is_valid):
+      i = np.argmax(is_valid)
       break
+    size = min(2 * size, PERTURB_BATCH_SIZE)
+  else:
+    # No valid candidate: fall back to the identity transform.
+    thetas, transes, i = np.zeros(1), np.zeros((1, 2)), 0
+    transforms = get_image_transform(thetas, transes, pivot)
+    _, new_pixels, new_rounded_pixels = _transform_pixels(
+        transforms, points, image_size)
+
+  transform = transforms[i]
+  transform_params = thetas[i], transes[i], pivot
+  new_pixels = [pixel[i] for pixel in new_pixels]
+  new_rounded_pixels = [pixel[i] for pixel in new_rounded_pixels]
 
   # Apply rigid transform to image and pixel labels.
   input_image = cv2.warpAffine(